@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from feedback import FEEDBACK_DTYPE
+from feedback_spool import read_records
+from pitch import note_name, note_number
+from sessions import DEFAULT_SESSION
+
+# usage: python3 analytics.py [--spool feedback_spool.jsonl] [--store analytics] [--session phone-1]
+# Adds what is new in the spool to the store, then prints the report as json.
+
+STORE_DIR = "analytics" # one file per column, see FeedbackStore
+SPOOL_FILE = "feedback_spool.jsonl" # combo.SPOOL_FILE
+NOTES = 128 # midi numbers
+
+# a row per played note: the FeedbackRecorder row and the song it is from
+COLUMNS = [(name, FEEDBACK_DTYPE[name]) for name in FEEDBACK_DTYPE.names] + [
+    ("song", np.dtype("i4")),     # index of the song in the store, in spool order
+    ("session", np.dtype("i2")),  # index into FeedbackStore.sessions
+    ("time", np.dtype("f8")),     # when the song was spooled
+]
+ROW_DTYPE = np.dtype(COLUMNS)
+
+
+class FeedbackStore:
+    """
+    Every note of the spooled feedback history, stored by column.
+
+    Each column is a flat binary file in `root`, opened as a read-only
+    np.memmap, so the analyses below only page in the columns they use and
+    millions of notes cost a few bytes of memory each. update() parses
+    only the spool records added since the last update and appends them.
+    meta.json has the row count and how far the spool was read, it is
+    written after the columns, so an update cut short is redone.
+    """
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self.meta = {"rows": 0, "songs": 0, "offset": 0, "sessions": []}
+        try:
+            with open(self.meta_path(), 'r') as file:
+                self.meta = json.load(file)
+        except (OSError, ValueError):
+            pass
+        self.sessions = self.meta["sessions"]
+        self.columns = {}
+        self.open()
+
+    def meta_path(self):
+        return os.path.join(self.root, "meta.json")
+
+    def column_path(self, name):
+        return os.path.join(self.root, name + ".bin")
+
+    def open(self):
+        rows = self.meta["rows"]
+        for name, dtype in COLUMNS:
+            if rows:
+                self.columns[name] = np.memmap(self.column_path(name), dtype=dtype, mode='r', shape=(rows,))
+            else:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def session_index(self, session):
+        session = session or DEFAULT_SESSION
+        if session not in self.sessions:
+            self.sessions.append(session)
+        return self.sessions.index(session)
+
+    def rows(self, records):
+        """ROW_DTYPE rows of spool records, each record is a song."""
+        songs = self.meta["songs"]
+        rows = []
+        for song, record in enumerate(records, songs):
+            session = self.session_index(record.get("session"))
+            when = record.get("time", 0)
+            for note in record.get("notes", []):
+                rows.append((note["position"], note_number(note["expected"]), note_number(note["played"]),
+                             note["expected_duration"], note["held"], note["onset"], song, session, when))
+        self.meta["songs"] = songs + len(records)
+        return np.array(rows, dtype=ROW_DTYPE)
+
+    def append(self, rows, offset):
+        os.makedirs(self.root, exist_ok=True)
+        count = self.meta["rows"]
+        for name, dtype in COLUMNS:
+            with open(self.column_path(name), 'ab') as file:
+                file.truncate(count * dtype.itemsize) # drop what an interrupted update left
+                file.write(np.ascontiguousarray(rows[name]).tobytes())
+        self.meta["rows"] = count + len(rows)
+        self.meta["offset"] = offset
+        tmp_path = self.meta_path() + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.meta, file)
+        os.replace(tmp_path, self.meta_path())
+
+    def update(self, spool_path=SPOOL_FILE, chunk_size=10000):
+        """
+        Adds the songs spooled since the last update
+        Returns:
+          rows (int): notes added
+        """
+        added = 0
+        offset, records = self.meta["offset"], []
+        for offset, record in read_records(spool_path, self.meta["offset"]):
+            records.append(record)
+            if len(records) == chunk_size:
+                rows = self.rows(records)
+                self.append(rows, offset)
+                added += len(rows)
+                records = []
+        if records:
+            rows = self.rows(records)
+            self.append(rows, offset)
+            added += len(rows)
+        self.open()
+        return added
+
+
+def select(store, session=None, since=None):
+    """
+    Parameters:
+      session (str): only this session's notes
+      since (float): only songs spooled at or after this time
+    Returns:
+      mask (np.ndarray): bool per row, None for all rows
+    """
+    mask = None
+    if session is not None:
+        index = store.sessions.index(session) if session in store.sessions else -1
+        mask = store["session"] == index
+    if since is not None:
+        recent = store["time"] >= since
+        mask = recent if mask is None else mask & recent
+    return mask
+
+
+def column(store, name, mask=None):
+    values = store[name]
+    return np.asarray(values) if mask is None else values[mask]
+
+
+def note_accuracy(store, mask=None):
+    """
+    Returns:
+      accuracy (dict): per expected note, how often it was played and how
+                       often the right note was played
+    """
+    expected = column(store, "expected", mask)
+    played = column(store, "played", mask)
+    valid = expected >= 0
+    expected, correct = expected[valid], (played == expected)[valid]
+    count = np.bincount(expected, minlength=NOTES)
+    hits = np.bincount(expected, weights=correct, minlength=NOTES)
+    return {note_name(int(midi)): {"count": int(count[midi]), "correct": int(hits[midi]),
+                                   "accuracy": round(float(hits[midi] / count[midi]), 4)}
+            for midi in np.flatnonzero(count)}
+
+
+def hold_error(store, mask=None):
+    """
+    How long the right notes were held against the song's duration for them
+    Returns:
+      error (dict): per note, the mean and root mean square of held minus
+                    expected seconds, and the mean of that error relative
+                    to the expected seconds
+    """
+    expected = column(store, "expected", mask)
+    right = (column(store, "played", mask) == expected) & (expected >= 0)
+    midi = expected[right]
+    duration = column(store, "expected_duration", mask)[right].astype(np.float64)
+    error = column(store, "held", mask)[right] - duration
+    count = np.bincount(midi, minlength=NOTES)
+    total = np.bincount(midi, weights=error, minlength=NOTES)
+    squares = np.bincount(midi, weights=error * error, minlength=NOTES)
+    ratios = np.bincount(midi, weights=np.divide(error, duration, out=np.zeros_like(error), where=duration > 0),
+                         minlength=NOTES)
+    return {note_name(int(m)): {"count": int(count[m]), "mean_error": round(float(total[m] / count[m]), 4),
+                                "rms_error": round(float(np.sqrt(squares[m] / count[m])), 4),
+                                "mean_relative_error": round(float(ratios[m] / count[m]), 4)}
+            for m in np.flatnonzero(count)}
+
+
+def confusion(store, mask=None):
+    """
+    Returns:
+      notes (list): note names, the rows and columns of the matrix
+      matrix (np.ndarray): matrix[i, j] is how often notes[j] was played for notes[i]
+    """
+    expected = column(store, "expected", mask)
+    played = column(store, "played", mask)
+    valid = (expected >= 0) & (played >= 0)
+    expected, played = expected[valid].astype(np.int32), played[valid].astype(np.int32)
+    matrix = np.bincount(expected * NOTES + played, minlength=NOTES * NOTES).reshape(NOTES, NOTES)
+    used = np.flatnonzero(matrix.any(axis=0) | matrix.any(axis=1))
+    return [note_name(int(midi)) for midi in used], matrix[np.ix_(used, used)]
+
+
+def session_trends(store, mask=None):
+    """
+    Accuracy of each session's songs over time, with a least squares line
+    through them
+    Returns:
+      trends (dict): per session the number of songs, mean and last song
+                     accuracy, and the change in accuracy per song
+    """
+    songs = store.meta["songs"]
+    song = column(store, "song", mask)
+    expected = column(store, "expected", mask)
+    right = column(store, "played", mask) == expected
+    count = np.bincount(song, weights=expected >= 0, minlength=songs)
+    hits = np.bincount(song, weights=right & (expected >= 0), minlength=songs)
+    song_session = np.full(songs, -1)
+    song_session[song] = column(store, "session", mask)
+
+    played = np.flatnonzero(count > 0) # in spool order, so in time order per session
+    if not len(played):
+        return {}
+    sessions = song_session[played]
+    accuracy = hits[played] / count[played]
+    order = np.argsort(sessions, kind="stable")
+    sessions, accuracy = sessions[order], accuracy[order]
+    starts = np.flatnonzero(np.r_[True, sessions[1:] != sessions[:-1]])
+    lengths = np.diff(np.r_[starts, len(sessions)])
+    x = np.arange(len(sessions)) - np.repeat(starts, lengths) # song number within the session
+
+    n = lengths.astype(np.float64)
+    sum_x = np.add.reduceat(x, starts).astype(np.float64)
+    sum_y = np.add.reduceat(accuracy, starts)
+    sum_xy = np.add.reduceat(x * accuracy, starts)
+    sum_xx = np.add.reduceat(x * x, starts).astype(np.float64)
+    denominator = n * sum_xx - sum_x * sum_x
+    slope = np.divide(n * sum_xy - sum_x * sum_y, denominator, out=np.zeros_like(n), where=denominator > 0)
+    last = accuracy[starts + lengths - 1]
+    return {store.sessions[sessions[start]]: {"songs": int(n[i]), "accuracy": round(float(sum_y[i] / n[i]), 4),
+                                              "last_accuracy": round(float(last[i]), 4),
+                                              "slope_per_song": round(float(slope[i]), 5)}
+            for i, start in enumerate(starts)}
+
+
+def report(store, session=None, since=None):
+    mask = select(store, session, since)
+    notes, matrix = confusion(store, mask)
+    return {
+        "notes": int(len(store) if mask is None else mask.sum()),
+        "songs": store.meta["songs"],
+        "accuracy": note_accuracy(store, mask),
+        "hold_error": hold_error(store, mask),
+        "confusion": {"notes": notes, "matrix": matrix.tolist()},
+        "sessions": session_trends(store, mask),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy, hold error, confusions and trends of the spooled feedback")
+    parser.add_argument("--spool", default=SPOOL_FILE, help="spool file of combo.py")
+    parser.add_argument("--store", default=STORE_DIR, help="directory of the columnar store")
+    parser.add_argument("--session", help="only this session")
+    parser.add_argument("--since", type=float, help="only songs spooled after this unix time")
+    args = parser.parse_args()
+
+    store = FeedbackStore(args.store)
+    store.update(args.spool)
+    print(json.dumps(report(store, args.session, args.since), indent=2))
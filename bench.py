@@ -0,0 +1,231 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+
+import combo
+from pitch import PitchDetector, note_frequency, note_name, note_number
+
+# usage: python3 bench.py [--target 0.95] [--quick] [--out bench.json]
+# Synthesises a stream of notes, runs it through combo.Listener with each
+# configuration of the tuning constants and recommends the cheapest one that
+# gets at least --target of the notes right.
+
+LOWEST, HIGHEST = "C3", "C6" # the notes with LEDs, see combo.NoteConversion
+PARAMETERS = ["WINDOW_SIZE", "WINDOW_STEP", "NUM_HPS", "WHITE_NOISE_THRESH", "SIG_TOLERANCE"]
+GRID = {
+    "WINDOW_SIZE": [12000, 24000, 48000],
+    "WINDOW_STEP": [3000, 6000, 12000],
+    "NUM_HPS": [3, 4, 5],
+    "WHITE_NOISE_THRESH": [0.1, 0.2, 0.4],
+    "SIG_TOLERANCE": [0.0001, 0.0005, 0.002],
+}
+QUICK_GRID = {
+    "WINDOW_SIZE": [24000, 48000],
+    "WINDOW_STEP": [6000, 12000],
+    "NUM_HPS": [3, 5],
+    "WHITE_NOISE_THRESH": [0.2],
+    "SIG_TOLERANCE": [0.0005],
+}
+
+
+def note_names(lowest=LOWEST, highest=HIGHEST):
+    """Every semitone from lowest to highest."""
+    return [note_name(number) for number in range(note_number(lowest), note_number(highest) + 1)]
+
+
+def synthesise(count=36, seed=0, sample_freq=combo.SAMPLE_FREQ, note_seconds=1.5, gap_seconds=0.5,
+               lead_seconds=2.0, harmonics=8, snr_db=(10, 30), detune_cents=20, hum=0.01, legato=False,
+               noise_step=1.0):
+    """
+    A stream of struck notes with decaying harmonics, each on top of white
+    noise at a random signal to noise ratio, detuned by a random amount and
+    with 60 Hz mains hum throughout
+    Parameters:
+      count (int): notes, drawn at random from C3 to C6
+      legato (bool): held notes of the same loudness with no gaps instead,
+                     longer than the noise floor's memory if count is
+      snr_db (tuple): range of the signal to noise ratio of a note in dB
+      detune_cents (float): largest detuning of a note
+      hum (float): amplitude of the hum
+      noise_step (float): noise and hum get this many times louder halfway
+                          through the lead, as when a fan is switched on
+    Returns:
+      samples (np.ndarray): float32 stream
+      notes (list): (start second, end second, note name) of each note
+    """
+    rng = np.random.default_rng(seed)
+    names = note_names()
+    if legato:
+        gap_seconds, snr_db = 0, (np.mean(snr_db),) * 2
+    note_len, gap_len, lead_len = int(note_seconds * sample_freq), int(gap_seconds * sample_freq), int(lead_seconds * sample_freq)
+    total = lead_len + count * (note_len + gap_len)
+    samples = np.zeros(total)
+    noise_rms = 0.01 * noise_step # of the notes, after the step
+    t = np.arange(note_len) / sample_freq
+    envelope = np.minimum(t / 0.005, 1) # 5 ms attack, then decay unless legato
+    if not legato:
+        envelope *= np.exp(-t / 1.2)
+    notes = []
+    start = lead_len # silence first, so the noise floor is known
+    for name in rng.choice(names, count):
+        freq = note_frequency(name) * 2**(rng.uniform(-detune_cents, detune_cents) / 1200)
+        tone = np.zeros(note_len)
+        for k in range(1, harmonics + 1):
+            if k * freq < sample_freq / 2:
+                tone += rng.uniform(0.5, 1) / k * np.sin(2 * np.pi * k * freq * t + rng.uniform(0, 2 * np.pi))
+        tone *= envelope
+        rms = np.sqrt(np.mean(tone[:sample_freq // 2]**2)) # of the loud part
+        tone *= noise_rms * 10**(rng.uniform(*snr_db) / 20) / rms
+        samples[start:start + note_len] += tone
+        notes.append((start / sample_freq, (start + note_len) / sample_freq, str(name)))
+        start += note_len + gap_len
+    t = np.arange(total) / sample_freq
+    background = rng.normal(0, 0.01, total) + hum * (np.sin(2 * np.pi * 60 * t) + 0.5 * np.sin(2 * np.pi * 180 * t))
+    background[lead_len // 2:] *= noise_step
+    samples += background
+    return samples.astype(np.float32), notes
+
+
+class InputLog:
+    """Stands in for the state machine, keeps every input with the stream time."""
+    def __init__(self):
+        self.now = 0.0
+        self.inputs = []
+
+    def handle_input(self, played_note, when=None):
+        self.inputs.append((self.now, played_note))
+
+
+def score(inputs, notes, stream_seconds, first_only=True):
+    """
+    A note counts as right if the first note the listener reports after it
+    starts (and before the next one starts) is that note. Without a gap the
+    window still has the previous note when the next starts, so with
+    first_only=False a note is right if it is reported at all before the
+    next one starts
+    Returns:
+      accuracy (float): share of notes right
+      latencies (list): seconds from the start of each right note to its report
+      spurious (int): notes reported before the first note starts
+    """
+    right, latencies = 0, []
+    ends = [start for start, _, _ in notes[1:]] + [stream_seconds]
+    reported = [(when, note) for when, note in inputs if note not in ("SILENCE", "ONSET")]
+    spurious = sum(when <= notes[0][0] for when, _ in reported)
+    i = 0
+    for (start, _, name), end in zip(notes, ends):
+        while i < len(reported) and reported[i][0] <= start:
+            i += 1
+        j = i
+        while not first_only and j < len(reported) and reported[j][0] <= end and reported[j][1] != name:
+            j += 1
+        if j < len(reported) and reported[j][0] <= end and reported[j][1] == name:
+            right += 1
+            latencies.append(reported[j][0] - start)
+    return right / len(notes), latencies, spurious
+
+
+def run(config, samples, notes, first_only=True, sample_freq=combo.SAMPLE_FREQ):
+    """
+    Streams the samples through a Listener built with config, as combo.setup does
+    Returns:
+      result (dict): the config, accuracy, detection latency and CPU time per frame
+    """
+    if config["WINDOW_STEP"] > config["WINDOW_SIZE"]:
+        return None
+    detector = PitchDetector(sample_freq, config["WINDOW_SIZE"], config["NUM_HPS"], combo.CONCERT_PITCH,
+                             config["WHITE_NOISE_THRESH"], octave_bands=combo.OCTAVE_BANDS)
+    detector.set_range(note_frequency(LOWEST, combo.CONCERT_PITCH) * 2**(-1/12),
+                       note_frequency(HIGHEST, combo.CONCERT_PITCH) * 2**(1/12))
+    log = InputLog()
+    step = config["WINDOW_STEP"]
+    listener = combo.Listener(log, detector, None, step, clock=lambda: log.now, tolerance=config["SIG_TOLERANCE"])
+    frame_times = []
+    for i in range(0, len(samples) - step + 1, step):
+        log.now = (i + step) / sample_freq
+        start = time.perf_counter()
+        listener.process(samples[i:i + step])
+        frame_times.append(time.perf_counter() - start)
+
+    stream_seconds = len(samples) / sample_freq
+    accuracy, latencies, spurious = score(log.inputs, notes, stream_seconds, first_only)
+    frame_times = np.array(frame_times)
+    latencies = np.array(latencies) if latencies else np.array([np.nan])
+    return {
+        "config": config,
+        "accuracy": round(accuracy, 4),
+        "spurious": spurious,
+        "latency_p50": round(float(np.median(latencies)), 3),
+        "latency_p95": round(float(np.percentile(latencies, 95)), 3),
+        "frame_p50_ms": round(float(np.median(frame_times)) * 1000, 3),
+        "frame_p95_ms": round(float(np.percentile(frame_times, 95)) * 1000, 3),
+        # share of one core the analysis needs in real time, what decides if the board keeps up
+        "cpu_load": round(float(frame_times.sum()) / stream_seconds, 4),
+    }
+
+
+def sweep(grid, samples, notes, progress=None, first_only=True):
+    """Runs every combination of the grid's values, returns the results."""
+    results = []
+    for values in itertools.product(*(grid[name] for name in PARAMETERS)):
+        result = run(dict(zip(PARAMETERS, values)), samples, notes, first_only)
+        if result is not None:
+            results.append(result)
+            if progress:
+                progress(result)
+    return results
+
+
+def recommend(results, target, max_latency=None):
+    """
+    Returns:
+      result (dict): the one with the lowest CPU load that gets at least target
+                     of the notes right (and reports them within max_latency),
+                     the most accurate one if none does
+    """
+    good = [result for result in results if result["accuracy"] >= target
+            and (max_latency is None or result["latency_p95"] <= max_latency)]
+    if not good:
+        return max(results, key=lambda result: (result["accuracy"], -result["cpu_load"]))
+    return min(good, key=lambda result: (result["cpu_load"], result["latency_p50"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark and tune the pitch detection constants of combo.py on synthetic notes")
+    parser.add_argument("--notes", type=int, default=36, help="synthetic notes in the stream")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--legato", action="store_true", help="held notes without gaps, tests the silence gate")
+    parser.add_argument("--lead", type=float, default=2.0, help="seconds of background noise before the first note")
+    parser.add_argument("--noise-step", type=float, default=1.0,
+                        help="the background gets this many times louder halfway through the lead, tests the noise floor")
+    parser.add_argument("--target", type=float, default=0.95, help="share of notes that has to be right")
+    parser.add_argument("--max-latency", type=float, help="largest p95 detection latency in seconds")
+    parser.add_argument("--quick", action="store_true", help="a smaller grid")
+    parser.add_argument("--out", help="also write the result to this file")
+    args = parser.parse_args()
+
+    samples, notes = synthesise(args.notes, args.seed, lead_seconds=args.lead, legato=args.legato,
+                                noise_step=args.noise_step)
+    current = {name: getattr(combo, name) for name in PARAMETERS}
+    grid = {name: sorted(set(values) | {current[name]}) for name, values in (QUICK_GRID if args.quick else GRID).items()}
+
+    def progress(result):
+        print(f"{result['config']} accuracy {result['accuracy']:.3f} spurious {result['spurious']} latency {result['latency_p50']:.2f}s "
+              f"frame {result['frame_p50_ms']:.2f}ms load {result['cpu_load']:.3f}", file=sys.stderr)
+
+    results = sweep(grid, samples, notes, progress, first_only=not args.legato)
+    result = {
+        "notes": len(notes),
+        "target": args.target,
+        "current": next(result for result in results if result["config"] == current),
+        "recommended": recommend(results, args.target, args.max_latency),
+        "results": sorted(results, key=lambda result: result["cpu_load"]),
+    }
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(result, file, indent=2)
@@ -1,27 +1,33 @@
-import copy
 import os
-import numpy as np
-import scipy.fftpack
-import sounddevice as sd
 import time
+from metrics import METRICS, Stopwatch
+BOOT = Stopwatch() # boot phases, from here to the first song, see main
+BOOT.start()
+
+import numpy as np
 import argparse
 import json
-import wave
-import requests
+import logging
 import subprocess
-import matplotlib.pyplot as plt
-from functools import partial
-from collections import deque
 
-from led_control import Strip
-from songs import Songs
-from state import NoteStateMachine
+from songs import Songs, compile_song, plan_notes
+from song_channel import SongChannel
+from song_library import SongLibrary, song_id
+from state import NoteStateMachine, State
+from pitch import PitchDetector, YinDetector, note_frequency
+from ring_buffer import RingBuffer, NoteHistory
+from pipeline import AnalysisPipeline
+from energy import EnergyTracker, NoiseFloor
+from onset import OnsetDetector
+from feedback import FeedbackRecorder, read_feedback
+from feedback_spool import FeedbackSpool, Uploader
+from progress import ProgressSender
+from logs import RateLimit, setup_logging
 
 SAMPLE_FREQ = 48000 # sample frequency in Hz
 WINDOW_SIZE = 48000 # window size of the DFT in samples
 WINDOW_STEP = 12000 # step size of window
 NUM_HPS = 5 # max number of harmonic product spectrums
-POWER_THRESH = 1e-6 # tuning is activated if the signal power exceeds this threshold
 CONCERT_PITCH = 440 # defining a1
 WHITE_NOISE_THRESH = 0.2 # everything under WHITE_NOISE_THRESH*avg_energy_per_freq is cut off
 
@@ -31,78 +37,144 @@ DELTA_FREQ = SAMPLE_FREQ / WINDOW_SIZE # frequency step width of the interpolate
 OCTAVE_BANDS = [50, 100, 200, 400, 800, 1600, 3200, 6400, 12800, 25600]
 
 SIG_TOLERANCE = 0.0005
+NOISE_FLOOR_SECONDS = 20 # the noise floor is the quietest silent block in this many seconds
+NOISE_FLOOR_MARGIN = 2 # windows with less than NOISE_FLOOR_MARGIN*noise floor + SIG_TOLERANCE power are silent
+NOISE_FLOOR_HOLD = 2 # seconds without a silent block or an attack, longer than a held note, before the floor rises
+NOISE_FLOOR_DOUBLING = 1 # seconds in which the rising floor doubles
+
+ANALYSIS_WORKERS = 3 # worker processes for the pitch detection, 0 analyses inside the audio callback
+MAX_FRAME_LAG = 2 # frames more than this many blocks old are dropped instead of analysed
+
+PITCH_ENGINE = "hps" # "hps" (one second spectrum) or "yin" (short frames, lower latency), see --engine
+YIN_WINDOW_SIZE = 4096 # frame length of the yin detector in samples
+YIN_WINDOW_STEP = 1024 # step size of the yin frames
+FFT_WORKERS = 1 # threads per FFT, more only pays off with ANALYSIS_WORKERS = 0
 
 MATCH_DELAY = 0.7 # Delay in seconds between allowed matches (0.5s to prevent rapid repeats)
-ALL_NOTES = ["A","A#","B","C","C#","D","D#","E","F","F#","G","G#"]
 
 MINIMUM_FEEDBACK_DURATION = 0.25
 NoteConversion = {'C6':1, 'B5':2, 'A5':3, 'G5':4, 'F5':5, 'E5':6, 'D5':7, 'C5':8, 'B4': 9, 'A4':10, 'G4':11, 'F4':12, 'E4':13, 'D4':14, 'C4':15, 'B3': 16, 'A3': 17, 'G3':18, 'F3':19, 'E3':20, 'D3':21, 'C3':22}
-strip = Strip()
-songs = Songs(MATCH_DELAY, strip, note_conversion=NoteConversion)
-feedback = []
-state_machine = NoteStateMachine(songs, feedback)
+# built by setup(), so the module can be imported off the board (see replay.py)
+strip = None
+songs = None
+feedback = None
+state_machine = None
 start_time = None
 played_notes = []
 
 SERVER_URL = "http://192.168.4.1:5000"
 file_path = "song.json"
 file_path_no_app = "song_no_app.json"
+METRICS_FILE = "metrics.json" # stage timings for the server's /metrics endpoint
+METRICS_INTERVAL = 5 # seconds between metrics.json updates
+STATE_LOG_FILE = "state_log.json" # the state machine's event log, written after each song
+FEEDBACK_FILE = "feedback.jsonl" # one line per played note, flushed while the song plays
+SPOOL_FILE = "feedback_spool.jsonl" # every song's feedback, kept until uploaded and after
+SONG_WAIT_TIMEOUT = 1 # seconds fetch_song blocks on the song channel at a time
+LOG_FILE = "player.log" # rotated, see logs.py
+FRAME_LOG_INTERVAL = 1 # seconds between messages from the same line in the audio path
+
+log = logging.getLogger("player")
+frame_log = logging.getLogger("player.frame") # logged from for every block
+frame_log.addFilter(RateLimit(FRAME_LOG_INTERVAL))
 
 def clear_file(file_path):
     # Open the file in write mode, which clears the contents
     with open(file_path, 'w'):
         pass  # No need to write anything, just open and close the file
     
+def ensure_hotspot():
+    # restarting the hotspot takes seconds, only do it if it isn't up already
+    active = subprocess.run(["systemctl", "is-active", "--quiet", "hostapd", "dnsmasq"]).returncode == 0
+    if not active:
+      subprocess.run(["sudo", "systemctl", "restart", "hostapd", "dnsmasq"], check=True)
+
+def pending_song():
+    # a song the server saved to song.json while no player was listening
+    try:
+      with open(file_path, 'r') as file:
+        content = file.read().strip()
+    except OSError:
+      return None
+    if not content:
+      return None
+    clear_file(file_path)
+    try:
+      return json.loads(content)
+    except ValueError as e:
+      log.warning("Invalid song file: %s", e)
+      return None
+
+def load_song(song_data):
+    """
+    Compiles a song, or takes it from the library if it was played before.
+    The server sends {"id": ...} alone to start a song from the library, a
+    damaged library file is deleted so the next upload compiles it again.
+    Returns:
+      song (dict): id, title, plan and the server's session, for Songs.setSong
+    Raises:
+      ValueError: if the song can't be played or the id is unknown
+    """
+    key = song_data.get("id") or song_id(song_data)
+    session = song_data.get("session")
+    try:
+      song = library.load(key)
+    except KeyError:
+      song = None
+    except ValueError as e:
+      log.warning("Dropping damaged song %s from the library: %s", key, e)
+      library.remove(key)
+      song = None
+    if song is not None and song["concert_pitch"] != CONCERT_PITCH:
+      song_data = {"title": song["title"], "notes": plan_notes(song["plan"])} # compiled for another tuning
+      song = None
+    if song is None:
+      if "notes" not in song_data:
+        raise ValueError(f"song {key} is not in the library")
+      plan = compile_song(song_data.get("notes"), NoteConversion, CONCERT_PITCH)
+      try:
+        library.save(key, song_data.get("title"), plan, CONCERT_PITCH)
+      except OSError as e:
+        log.warning("Could not add song %s to the library: %s", key, e) # still playable
+      song = {"id": key, "title": song_data.get("title"), "plan": plan}
+    song["session"] = session
+    return song
+
 def fetch_song():
-    # fetching the song data from the server 
-    data_recv = False
-    song_data = None
-    print("FETCH")
-    time.sleep(5)
-    while not data_recv:
+    # waits for the server to hand over a song, see song_channel.py
+    log.info("Waiting for a song")
+    song_data = pending_song()
+    while True:
       try:
-          # response = requests.post(f"{SERVER_URL}/receive_json")
-          response = requests.post(f"{SERVER_URL}/receive_json", timeout=10)
-          # print("Status code:", response.status_code)
-          # print("Response text:", response.text)
-          with open(file_path, 'r') as file:
-            content = file.read().strip()  # Read content and remove any extra whitespace
-            if content:
-                data_recv = True
-                song_data = json.loads(content)
-                songs.setSong(song_data)
-                state_machine.transition("starting") #go back to starting
-                print("File has data:", content)
-            else:
-                print("File is empty")
-          time.sleep(1)
-
-      except Exception as e:
-          print(f"Error fetching song: {e}")
-    
-    clear_file(file_path)
+        if song_data is None:
+          song_data = channel.get(timeout=SONG_WAIT_TIMEOUT) # checked, so already loaded
+          if song_data is None:
+            continue
+        elif "plan" not in song_data:
+          song_data = load_song(song_data)
+        songs.setSong(song_data)
+      except ValueError as e:
+        log.warning("Invalid song: %s", e)
+        song_data = None
+        continue
+      state_machine.transition(State.STARTING) #go back to starting
+      return
 
 
-def find_closest_note(pitch):
+def make_detector(engine):
   """
-  This function finds the closest note for a given pitch
-  Parameters:
-    pitch (float): pitch given in hertz
+  Builds the pitch detector for an engine name
   Returns:
-    closest_note (str): e.g. a, g#, ..
-    closest_pitch (float): pitch of the closest note in hertz
+    detector: PitchDetector or YinDetector
+    window_step (int): block size to read from the input stream
   """
-  i = int(np.round(np.log2(pitch/CONCERT_PITCH)*12))
-  closest_note = ALL_NOTES[i%12] + str(4 + (i + 9) // 12)
-  closest_pitch = CONCERT_PITCH*2**(i/12)
-  return closest_note, closest_pitch
-
-sig = deque(maxlen= 10)
-vol = []
-
-
-HANN_WINDOW = np.hanning(WINDOW_SIZE)
-MINIMUM_SILENCE_DURATION = 5
+  if engine == "yin":
+    return YinDetector(SAMPLE_FREQ, YIN_WINDOW_SIZE, CONCERT_PITCH, fft_workers=FFT_WORKERS), YIN_WINDOW_STEP
+  if engine == "hps":
+    detector = PitchDetector(SAMPLE_FREQ, WINDOW_SIZE, NUM_HPS, CONCERT_PITCH, WHITE_NOISE_THRESH,
+                             octave_bands=OCTAVE_BANDS, fft_workers=FFT_WORKERS)
+    return detector, WINDOW_STEP
+  raise ValueError(f"Unknown pitch engine: {engine}")
 
 def get_rpi_device():
     devices = sd.query_devices()
@@ -111,97 +183,161 @@ def get_rpi_device():
             return i  # Return the index of the Raspberry Pi audio input device
     return None  # Return None if not found
 
-def callback(indata, frames, time, status):
+class Listener:
   """
-  Callback function of the InputStream method.
+  Analysis state of one input stream, fed one block at a time by callback.
   """
-  # define static variables
-  if not hasattr(callback, "window_samples"):
-    callback.window_samples = [0 for _ in range(WINDOW_SIZE)]
-  if not hasattr(callback, "noteBuffer"):
-    callback.noteBuffer = ["1","2"]
-  if not hasattr(callback, "mean_sig"):
-    callback.mean_sig = 0
-  if not hasattr(callback, "sig_buffer"):
-    callback.sig_buffer = deque(maxlen= 10)
-
-  if status:
-    print(status)
-    return
-  if any(indata):
-    callback.window_samples = np.concatenate((callback.window_samples, indata[:, 0])) # append new samples
-    callback.window_samples = callback.window_samples[len(indata[:, 0]):] # remove old samples
-
-    # skip if signal power is too low
-    signal_power = (np.linalg.norm(callback.window_samples, ord=2)**2) / len(callback.window_samples)
-    signal_power = signal_power * 1000
-
-    if signal_power < callback.mean_sig - SIG_TOLERANCE:
-      os.system('cls' if os.name=='nt' else 'clear')
-      callback.sig_buffer.append(signal_power)
-      callback.mean_sig  = np.mean(callback.sig_buffer)  # Output: 30.0
-      state_machine.handle_input("SILENCE")
-
-      # print ("Mean", callback.mean_sig )
-      # print(signal_power)
-      return
-
-    # avoid spectral leakage by multiplying the signal with a hann window
-    hann_samples = callback.window_samples * HANN_WINDOW
-    magnitude_spec = abs(scipy.fftpack.fft(hann_samples)[:len(hann_samples)//2])
-
-    # supress mains hum, set everything below 62Hz to zero
-    for i in range(int(62/DELTA_FREQ)):
-      magnitude_spec[i] = 0
-
-
-    # calculate average energy per frequency for the octave bands
-    # and suppress everything below it
-    for j in range(len(OCTAVE_BANDS)-1):
-      ind_start = int(OCTAVE_BANDS[j]/DELTA_FREQ)
-      ind_end = int(OCTAVE_BANDS[j+1]/DELTA_FREQ)
-      ind_end = ind_end if len(magnitude_spec) > ind_end else len(magnitude_spec)
-      avg_energy_per_freq = (np.linalg.norm(magnitude_spec[ind_start:ind_end], ord=2)**2) / (ind_end-ind_start)
-      avg_energy_per_freq = avg_energy_per_freq**0.5
-      for i in range(ind_start, ind_end):
-        magnitude_spec[i] = magnitude_spec[i] if magnitude_spec[i] > WHITE_NOISE_THRESH*avg_energy_per_freq else 0
-
-    # interpolate spectrum
-    mag_spec_ipol = np.interp(np.arange(0, len(magnitude_spec), 1/NUM_HPS), np.arange(0, len(magnitude_spec)),
-                              magnitude_spec)
-    mag_spec_ipol = mag_spec_ipol / np.linalg.norm(mag_spec_ipol, ord=2) #normalize it
+  def __init__(self, state_machine, detector, songs=None, window_step=WINDOW_STEP, clock=time.perf_counter,
+               tolerance=SIG_TOLERANCE):
+    self.state_machine = state_machine
+    self.clock = clock # the state machine's, attacks are timed with it
+    self.detector = detector
+    self.songs = songs # tells the detector which notes to expect
+    self.expected = []
+    self.window = RingBuffer(detector.window_size, np.float32) # analysis window, starts out silent
+    self.note_buffer = NoteHistory(2)
+    self.energy = EnergyTracker(detector.window_size)
+    self.onsets = OnsetDetector(SAMPLE_FREQ)
+    blocks_per_second = SAMPLE_FREQ / window_step
+    self.noise_floor = NoiseFloor(int(NOISE_FLOOR_SECONDS * blocks_per_second), NOISE_FLOOR_MARGIN, tolerance,
+                                  int(NOISE_FLOOR_HOLD * blocks_per_second),
+                                  2**(1 / (NOISE_FLOOR_DOUBLING * blocks_per_second)))
+
+  def process(self, samples):
+    start = time.perf_counter()
+    signal_power, silent, onset = self.measure(samples, self.window.oldest(len(samples)))
+    self.window.extend(samples) # append new samples, dropping the oldest
+    if silent:
+      self.handle(signal_power, "SILENCE", onset)
+    else:
+      signal_power, closest_note = self.analyse(self.window.view(), signal_power, self.expected)
+      METRICS.record_laps(self.detector.stopwatch.drain())
+      self.handle(signal_power, closest_note, onset)
+    METRICS.record("frame", time.perf_counter() - start)
+
+  def measure(self, samples, outgoing):
+    """
+    Silence gate and onset detection, O(block) so they can run on every block in the audio callback
+    Parameters:
+      samples (np.ndarray): the new block
+      outgoing (np.ndarray): the samples it pushes out of the analysis window
+    Returns:
+      signal_power (float): scaled mean power of the analysis window
+      silent (bool): True if the window is too close to the noise floor to analyse
+      onset (float): clock time of the last attack in this block, None if there was none
+    """
+    start = time.perf_counter()
+    signal_power = self.energy.update(samples, outgoing) * 1000
+    block_power = self.energy.block_power * 1000
+    METRICS.record("power", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    attacks = self.onsets.process(samples) # seconds before the end of the block, which is now
+    METRICS.record("onset", time.perf_counter() - start)
+    threshold = self.noise_floor.add(block_power, bool(attacks))
+    # attacks in background noise don't count
+    onset = None
+    if attacks and block_power > threshold:
+      onset = self.clock() - min(attacks)
+    return signal_power, signal_power < threshold, onset
+
+  def analyse(self, window_samples, signal_power, expected=()):
+    """
+    Detects the note in a window, the pipeline's workers do the same with their copy of the detector (see pipeline.py)
+    Parameters:
+      window_samples (np.ndarray): the analysis window
+      signal_power (float): from measure(), passed through
+      expected (list): frequencies of the notes the song expects next
+    Returns:
+      signal_power (float): scaled mean power of the window
+      closest_note (str): detected note or None if undecided
+    """
+    self.detector.stopwatch.start()
+    closest_note, closest_pitch = self.detector.detect(window_samples, expected)
+    return signal_power, closest_note
+
+  def handle(self, signal_power, closest_note, onset=None):
+    """Passes the result of measure()/analyse() on to the state machine, in stream order."""
+    start = time.perf_counter()
+    if onset is not None:
+      self.state_machine.handle_input("ONSET", onset)
+
+    if closest_note == "SILENCE":
+      self.state_machine.handle_input("SILENCE")
 
-    hps_spec = copy.deepcopy(mag_spec_ipol)
+    else:
+      self.note_buffer.push(closest_note)
+      if closest_note is not None and self.note_buffer.stable():
+        self.state_machine.handle_input(closest_note)
 
-    # calculate the HPS
-    for i in range(NUM_HPS):
-      tmp_hps_spec = np.multiply(hps_spec[:int(np.ceil(len(mag_spec_ipol)/(i+1)))], mag_spec_ipol[::(i+1)])
-      if not any(tmp_hps_spec):
-        break
-      hps_spec = tmp_hps_spec
+      else:
+        frame_log.debug("Closest note: %s, not stable yet", closest_note)
+        self.state_machine.handle_input("SILENCE")
 
-    max_ind = np.argmax(hps_spec)
-    max_freq = max_ind * (SAMPLE_FREQ/WINDOW_SIZE) / NUM_HPS
-    closest_note, closest_pitch = find_closest_note(max_freq)
-    max_freq = round(max_freq, 1)
-    closest_pitch = round(closest_pitch, 1)
+    if self.songs is not None:
+      self.expected = self.songs.expectedFrequencies()
+    METRICS.record("state", time.perf_counter() - start)
 
-    callback.noteBuffer.insert(0, closest_note) # ringbuffer
-    callback.noteBuffer.pop()
 
-    os.system('cls' if os.name=='nt' else 'clear')
-    if callback.noteBuffer.count(callback.noteBuffer[0]) == len(callback.noteBuffer):
-      state_machine.handle_input(closest_note)
+detector = None
+window_step = WINDOW_STEP
+listener = None
+pipeline = None # set while the analysis runs in worker processes
+channel = None # SongChannel the server hands songs to, opened by main
+library = SongLibrary() # every song played so far, compiled
 
+def setup(led_strip, engine=PITCH_ENGINE, clock=time.perf_counter, feedback_path=FEEDBACK_FILE, progress=None):
+  """
+  Builds the song player, state machine and listener that callback feeds
+  Parameters:
+    led_strip: Strip, or any object with the same methods
+    engine (str): pitch engine, see make_detector
+    clock: time source of the state machine
+    feedback_path (str): file the feedback recorder flushes to
+    progress: ProgressSender for the live note events, None for none
+  """
+  global strip, songs, feedback, state_machine, detector, window_step, listener
+  strip = led_strip
+  songs = Songs(MATCH_DELAY, strip, note_conversion=NoteConversion, concert_pitch=CONCERT_PITCH)
+  feedback = FeedbackRecorder(feedback_path)
+  state_machine = NoteStateMachine(songs, feedback, clock=clock, progress=progress)
+  detector, window_step = make_detector(engine)
+  # only search the notes the LEDs can show, with a semitone to spare
+  lowest, highest = songs.noteRange()
+  detector.set_range(note_frequency(lowest, CONCERT_PITCH) * 2**(-1/12),
+                     note_frequency(highest, CONCERT_PITCH) * 2**(1/12))
+  listener = Listener(state_machine, detector, songs, window_step, clock)
+  # one block of audio is the budget for handling a block
+  METRICS.stage("frame", deadline=window_step / SAMPLE_FREQ)
+  METRICS.stage("callback", deadline=window_step / SAMPLE_FREQ)
+
+def filter_feedback(records):
+  """
+  Feedback in the format the app expects, one {played note: held seconds} per
+  recorded note, empty for notes held for less than MINIMUM_FEEDBACK_DURATION
+  Parameters:
+    records: rows from FeedbackRecorder.flush() or read_feedback()
+  """
+  return [{record["played"]: record["held"]} if record["held"] >= MINIMUM_FEEDBACK_DURATION else {}
+          for record in records]
 
+def callback(indata, frames, time_info, status):
+  """
+  Callback function of the InputStream method.
+  """
+  start = time.perf_counter()
+  if status:
+    frame_log.warning("Input stream: %s", status)
+    METRICS.count("input_status")
+    return
+  if indata.any():
+    if pipeline:
+      pipeline.push(indata[:, 0])
     else:
-      print(f"Closest note: ...")
-      callback.sig_buffer.append(signal_power)
-      callback.mean_sig  = np.mean(callback.sig_buffer)  # Output: 30.0
-      state_machine.handle_input("SILENCE")
-
+      listener.process(indata[:, 0])
   else:
-    print('no input')
+    frame_log.debug("No input")
+  METRICS.record("callback", time.perf_counter() - start)
 
 
 def ping_server():
@@ -217,37 +353,82 @@ def ping_server():
 
 if __name__ == '__main__':
     # Process arguments
-      subprocess.run(["sudo", "systemctl", "restart", "hostapd", "dnsmasq"], check=True) 
+      parser = argparse.ArgumentParser()
+      parser.add_argument("--engine", choices=["hps", "yin"], default=PITCH_ENGINE,
+                          help="pitch detector, yin reacts faster to new notes")
+      parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS,
+                          help="analysis worker processes, 0 to analyse in the audio callback")
+      parser.add_argument("--debug", action="store_true",
+                          help="log every step of the analysis too, at most once a second per message")
+      args = parser.parse_args()
+      setup_logging(LOG_FILE, debug=args.debug)
+      BOOT.lap("boot_import")
+
+      # only needed on the board, and slow to import
+      import sounddevice as sd
+      from led_control import Strip
+      setup(Strip(), args.engine, progress=ProgressSender()) # streamed by the server's /progress
       strip.rainbow()
       strip.colourWipe()
       strip.show_ON() #show that running
-      clear_file(file_path)
-      clear_file("feedback.json")
+      BOOT.lap("boot_hardware")
+
+      channel = SongChannel(check=load_song) # a song the player can't play is rejected before it is accepted
+      ensure_hotspot()
+      BOOT.lap("boot_network")
+      spool = FeedbackSpool(SPOOL_FILE)
+      uploader = Uploader(spool, f"{SERVER_URL}/send_feedback").start() # also sends what an earlier run left
+      feedback.reset()
 #      server_process = subprocess.Popen(["python3", "wifi-server.py"])
       try:
         while True:
           fetch_song()
+          BOOT.lap("boot_first_song")
+          boot = BOOT.drain() # later songs don't lap
+          if boot:
+            METRICS.record_laps(boot)
+            log.info("Boot: " + ", ".join(f"{name[5:]} {seconds:.2f}s" for name, seconds in boot))
           strip.colourWipe()
           rpi_device = get_rpi_device()
-          print(f"Raspberry Pi audio device number: {rpi_device}")
-          with sd.InputStream(device=rpi_device, channels=1, callback=callback, blocksize=WINDOW_STEP, samplerate=SAMPLE_FREQ):
+          log.info("Raspberry Pi audio device number: %s", rpi_device)
+          if args.workers > 0:
+            pipeline = AnalysisPipeline(listener, window_step, args.workers, MAX_FRAME_LAG)
+            pipeline.start()
+          with sd.InputStream(device=rpi_device, channels=1, callback=callback, blocksize=window_step, samplerate=SAMPLE_FREQ):
+              last_metrics = 0
               while not songs.FINISHED:
                 time.sleep(0.25)
+                if time.time() - last_metrics > METRICS_INTERVAL:
+                  METRICS.write(METRICS_FILE)
+                  feedback.flush()
+                  last_metrics = time.time()
+          if pipeline:
+            pipeline.stop()
+            log.info("Dropped %d stale frames", pipeline.dropped)
+            METRICS.write(METRICS_FILE)
+            pipeline = None
+          state_machine.log.write(STATE_LOG_FILE)
 
           strip.endSeq()
-          filtered_feedback = [{k: v for k, v in note.items() if v >= MINIMUM_FEEDBACK_DURATION} for note in feedback] 
+          feedback.flush()
+          notes = list(read_feedback(FEEDBACK_FILE))
+          filtered_feedback = filter_feedback(notes)
 
-          print(filtered_feedback)
+          log.info("Feedback: %s", filtered_feedback)
           strip.showIndicator(1)
-          headers = {"Content-Type": "application/json"}
-          response = requests.post(f"{SERVER_URL}/send_feedback", data=json.dumps(filtered_feedback), headers=headers)
-          print(f"Server Response: {response.status_code}, {response.text}")
-          clear_file("feedback.json")
+          # the uploader sends it to the server in the background, the spool keeps it until then
+          spool.append(filtered_feedback, notes=notes, session=songs.session)
+          uploader.notify()
+          feedback.reset()
           strip.turn_OFF(1)
           strip.show_ON()
 
       except KeyboardInterrupt:
+          state_machine.log.write(STATE_LOG_FILE)
           strip.colourWipe()
-          print(feedback)
+          strip.close()
+          feedback.flush()
+          channel.close()
+          uploader.stop()
           subprocess.run(["sudo", "systemctl", "restart", "hostapd", "dnsmasq"], check=True)
 
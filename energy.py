@@ -0,0 +1,94 @@
+from collections import deque
+
+import numpy as np
+
+
+class EnergyTracker:
+    """
+    Sum of squares of a sliding window, updated per block in O(block): the
+    incoming block is added and the block that falls out of the window is
+    subtracted, instead of recomputing the whole window.
+    """
+    def __init__(self, window_size):
+        self.window_size = window_size
+        self.energy = 0.0  # sum of squares over the window
+        self.block_power = 0.0  # mean square of the last block
+
+    def update(self, incoming, outgoing):
+        """
+        Parameters:
+          incoming (np.ndarray): the new block
+          outgoing (np.ndarray): the samples the block pushes out of the window
+        Returns:
+          power (float): mean square of the window
+        """
+        # as python floats, the running sum must not be kept in the samples' float32
+        incoming_energy = float(np.dot(incoming, incoming))
+        self.energy += incoming_energy - float(np.dot(outgoing, outgoing))
+        # the running sum only ever drifts by rounding, don't let that go negative
+        if self.energy < 0:
+            self.energy = 0.0
+        self.block_power = incoming_energy / len(incoming)
+        return self.energy / self.window_size
+
+
+class NoiseFloor:
+    """
+    Running minimum of the power of quiet blocks over the last `length`
+    blocks, a minimum statistics estimate of the background noise.
+
+    A block is quiet if its power is under threshold(), the power a window
+    needs to count as sound. Playing never goes into the minimum, so a long
+    passage without a gap doesn't become the floor, the last floor is kept
+    until quiet blocks come again. Until the first block every block counts.
+
+    A floor that is too low lets nothing count as quiet, e.g. after the room
+    got louder. So once no block has been quiet and nothing has been struck
+    for `hold` blocks, the floor rises by `rise` per block until the
+    background is quiet again, which then replaces the old minimum. Playing
+    keeps striking notes, which holds the floor where it is.
+    Amortised O(1) per block.
+    """
+    def __init__(self, length, margin=2, tolerance=0.0, hold=None, rise=1.0):
+        self.length = length
+        self.margin = margin  # sound is more than margin times the floor ...
+        self.tolerance = tolerance  # ... plus tolerance
+        self.hold = length if hold is None else hold
+        self.rise = rise
+        self.minima = deque()  # (block index, power), increasing in both
+        self.index = 0
+        self.loud = 0  # blocks since the last one that was quiet or struck
+        self.raised = 1.0  # factor the floor has risen by
+
+    def add(self, power, attack=False):
+        """
+        Parameters:
+          power (float): mean square of the next block
+          attack (bool): a note was struck in the block
+        Returns:
+          threshold (float): see threshold()
+        """
+        quiet = not self.minima or power < self.threshold()
+        if quiet:
+            if self.raised > 1:
+                # the old minimum is below today's background
+                self.minima.clear()
+                self.raised = 1.0
+            while self.minima and self.minima[-1][1] >= power:
+                self.minima.pop()
+            self.minima.append((self.index, power))
+        # the newest quiet block stays however old it is
+        while len(self.minima) > 1 and self.minima[0][0] <= self.index - self.length:
+            self.minima.popleft()
+        self.loud = 0 if quiet or attack else self.loud + 1
+        if self.loud > self.hold:
+            self.raised *= self.rise
+        self.index += 1
+        return self.threshold()
+
+    def threshold(self):
+        return self.floor * self.margin + self.tolerance
+
+    @property
+    def floor(self):
+        return self.minima[0][1] * self.raised if self.minima else 0.0
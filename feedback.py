@@ -0,0 +1,111 @@
+import json
+import threading
+
+import numpy as np
+
+from pitch import note_name, note_number
+
+# one row per note played, notes are stored as midi numbers (-1 for none)
+FEEDBACK_DTYPE = np.dtype([
+    ("position", "i4"),           # index of the expected note in the song
+    ("expected", "i2"),
+    ("played", "i2"),
+    ("expected_duration", "f4"),  # seconds
+    ("held", "f4"),               # seconds the played note was held
+    ("onset", "f8"),              # clock time the played note started
+])
+
+
+class FeedbackRecorder:
+    """
+    Records how each note of a song was played.
+
+    Rows go into a preallocated chunk of FEEDBACK_DTYPE records. record()
+    runs on the audio path, so it only ever fills chunks: when one is full
+    it is queued and a spare one takes its place. flush(), on another
+    thread, swaps out the queued and the current chunk under the lock,
+    then turns their rows into json lines and appends them to `path`
+    outside it, and hands the chunks back as spares. Memory stays the same
+    however long the session is as long as flush() is called every so
+    often, and the file has every note so far while the song is still
+    playing.
+    """
+    def __init__(self, path=None, chunk_size=64):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.rows = np.zeros(chunk_size, dtype=FEEDBACK_DTYPE)
+        self.spare = [np.zeros(chunk_size, dtype=FEEDBACK_DTYPE)]
+        self.full = []  # (chunk, rows) filled since the last flush, oldest first
+        self.count = 0  # rows in the current chunk
+        self.total = 0  # rows recorded since reset()
+        self.lock = threading.Lock()  # held by record() and the swaps, never during I/O
+        self.write_lock = threading.Lock()  # keeps flushes in order
+
+    def record(self, position, expected, played, expected_duration, held, onset):
+        with self.lock:
+            self.rows[self.count] = (position, note_number(expected), note_number(played),
+                                     expected_duration or 0, held, onset or 0)
+            self.count += 1
+            self.total += 1
+            if self.count == self.chunk_size:
+                self.full.append((self.rows, self.count))
+                self.rows = self.spare.pop() if self.spare else np.zeros(self.chunk_size, dtype=FEEDBACK_DTYPE)
+                self.count = 0
+
+    def swap(self):
+        # the chunks with rows, an empty one takes the place of the current one
+        chunks, self.full = self.full, []
+        if self.count:
+            chunks.append((self.rows, self.count))
+            self.rows = self.spare.pop() if self.spare else np.zeros(self.chunk_size, dtype=FEEDBACK_DTYPE)
+            self.count = 0
+        return chunks
+
+    def recycle(self, chunks):
+        # one spare is kept, the audio path allocates only if two chunks fill between flushes
+        if chunks and not self.spare:
+            self.spare.append(chunks[0][0])
+
+    def flush(self):
+        """
+        Serialises the rows recorded since the last flush
+        Returns:
+          records (list): the flushed rows as dicts, notes by name
+        """
+        with self.write_lock:
+            with self.lock:
+                chunks = self.swap()
+            records = [{
+                "position": int(row["position"]),
+                "expected": note_name(int(row["expected"])),
+                "played": note_name(int(row["played"])),
+                "expected_duration": round(float(row["expected_duration"]), 3),
+                "held": round(float(row["held"]), 3),
+                "onset": round(float(row["onset"]), 3),
+            } for chunk, count in chunks for row in chunk[:count]]
+            if self.path and records:
+                with open(self.path, 'a') as file:
+                    file.writelines(json.dumps(record) + "\n" for record in records)
+            with self.lock:
+                self.recycle(chunks)
+            return records
+
+    def reset(self):
+        """Drops unflushed rows and empties the file, for a new song."""
+        with self.write_lock:
+            with self.lock:
+                self.recycle(self.swap())
+                self.total = 0
+            if self.path:
+                open(self.path, 'w').close()
+
+    def __len__(self):
+        return self.total
+
+
+def read_feedback(path):
+    """Yields the rows a FeedbackRecorder wrote to path, as dicts."""
+    with open(path, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,224 @@
+import gzip
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from metrics import METRICS
+
+log = logging.getLogger("player.upload")
+
+
+def read_records(path, offset=0, limit=None):
+    """
+    Yields (end offset, record) for the records of a spool file from byte
+    offset on. A line that isn't a json record (damaged by a crash or a
+    full disk) is logged and skipped.
+    """
+    try:
+        file = open(path, 'rb')
+    except OSError:
+        return
+    with file:
+        file.seek(offset)
+        count = 0
+        for line in file:
+            offset += len(line)
+            if not line.endswith(b"\n"):
+                break  # a record still being written
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict):
+                METRICS.count("spool_bad_records")
+                log.warning("Skipping a damaged record in %s before byte %d", path, offset)
+                continue
+            yield offset, record
+            count += 1
+            if limit is not None and count >= limit:
+                break
+
+
+class FeedbackSpool:
+    """
+    Append-only json lines file with one record per finished song, fsynced
+    so feedback survives a crash or power cut. A sidecar file remembers the
+    byte offset up to which records have been uploaded.
+    """
+    def __init__(self, path="feedback_spool.jsonl"):
+        self.path = path
+        self.sent_path = path + ".sent"
+        self.lock = threading.Lock()
+        self.sent = 0  # byte offset of the first record not uploaded yet
+        self.seq = 0  # seq of the last record
+        try:
+            with open(self.sent_path, 'r') as file:
+                self.sent = json.load(file)["offset"]
+        except (OSError, ValueError, KeyError):
+            pass
+        self.truncate_torn_tail()
+        for _, record in self.read(0):
+            self.seq = record.get("seq", self.seq)
+
+    def truncate_torn_tail(self, block_size=4096):
+        """Cuts off a record a crash left half written, the next append would be glued onto it."""
+        try:
+            file = open(self.path, 'rb+')
+        except OSError:
+            return
+        with file:
+            size = end = file.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(end - block_size, 0)
+                file.seek(start)
+                newline = file.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                log.warning("Dropping %d bytes of a half written record at the end of %s", size - end, self.path)
+                file.truncate(end)
+                self.sent = min(self.sent, end)
+
+    def append(self, feedback, **fields):
+        """
+        Parameters:
+          feedback (list): the payload the app gets, see combo.filter_feedback
+          fields: anything else to keep with it, e.g. the per note rows
+        Returns:
+          seq (int): number of the record
+        """
+        with self.lock:
+            self.seq += 1
+            record = dict(fields, seq=self.seq, time=time.time(), feedback=feedback)
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            return self.seq
+
+    def read(self, offset, limit=None):
+        """Yields (end offset, record) for the records from byte offset on."""
+        return read_records(self.path, offset, limit)
+
+    def pending(self, limit):
+        """Returns (end offset, records) of up to limit records not uploaded yet."""
+        end, records = self.sent, []
+        for end, record in self.read(self.sent, limit):
+            records.append(record)
+        return end, records
+
+    def mark_sent(self, offset):
+        tmp_path = self.sent_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"offset": offset}, file)
+        os.replace(tmp_path, self.sent_path)
+        self.sent = offset
+
+
+class Uploader:
+    """
+    Background thread that drains a FeedbackSpool to the server's
+    /send_feedback in batches, over one kept-alive connection, gzipped if
+    compress is set. Failed uploads are retried with exponential backoff,
+    the spool keeps the records meanwhile. A batch the server rejects
+    (a 4xx other than 408 and 429) won't get through however often it is
+    sent: its records are sent one by one and the ones rejected on their
+    own are skipped.
+    """
+    def __init__(self, spool, url, batch_size=16, compress=True, timeout=10,
+                 min_backoff=1, max_backoff=60):
+        import requests  # slow to import, see combo.py
+        self.spool = spool
+        self.url = url
+        self.batch_size = batch_size
+        self.compress = compress
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.errors = (requests.RequestException, OSError)
+        self.http_error = requests.HTTPError
+        self.rejected = None  # end offset of a rejected batch, records up to it go one by one
+        self.wake = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def notify(self):
+        """Call after appending to the spool, uploads right away instead of at the next check."""
+        self.wake.set()
+
+    def upload(self, records):
+        body = json.dumps({"batch": records}).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        response = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+
+    def rejects(self, error):
+        # the server won't take this request however often it is sent
+        status = getattr(error.response, "status_code", None)
+        return isinstance(error, self.http_error) and status is not None and 400 <= status < 500 \
+            and status not in (408, 429)
+
+    def run(self):
+        backoff = self.min_backoff
+        while self.running:
+            try:
+                self.step()
+                backoff = self.min_backoff
+            except Exception as e:
+                # the server is likely down, don't wake on new records before the backoff
+                METRICS.count("upload_errors")
+                if isinstance(e, self.errors):
+                    log.warning("Feedback upload failed, retrying in %.1fs: %s", backoff, e)
+                else:
+                    log.exception("Feedback upload failed, retrying in %.1fs", backoff)
+                time.sleep(backoff * random.uniform(0.5, 1))
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def step(self):
+        """Uploads the next batch, or waits for one."""
+        batch_size = self.batch_size if self.rejected is None else 1
+        end, records = self.spool.pending(batch_size)
+        if not records:
+            self.wake.wait(self.max_backoff)
+            self.wake.clear()
+            return
+        start = time.perf_counter()
+        try:
+            self.upload(records)
+        except self.errors as e:
+            if not self.rejects(e):
+                raise
+            if len(records) > 1:
+                log.warning("Feedback batch rejected, sending its records one by one: %s", e)
+                self.rejected = end
+                return
+            METRICS.count("upload_rejected")
+            log.error("Feedback record %s rejected, skipping it: %s", records[0].get("seq"), e)
+        else:
+            METRICS.record("upload", time.perf_counter() - start)
+            METRICS.count("uploaded_sessions", len(records))
+        self.spool.mark_sent(end)
+        if self.rejected is not None and end >= self.rejected:
+            self.rejected = None
+
+    def stop(self, timeout=5):
+        """Gives the thread timeout seconds to finish an upload in flight."""
+        self.running = False
+        self.wake.set()
+        self.thread.join(timeout)
+        self.session.close()
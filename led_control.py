@@ -1,8 +1,20 @@
+import bisect
+import logging
+import threading
 import time
-from rpi_ws281x import *
 
+from metrics import METRICS
+
+
+log = logging.getLogger("player.leds")
 
 # LED strip configuration:
+FRAME_INTERVAL = 0.01 # seconds between pushes to the LEDs, updates in between are merged
+
+
+def Color(red, green, blue, white=0):
+    """24 bit colour, packed the way rpi_ws281x.Color does."""
+    return (white << 24) | (red << 16) | (green << 8) | blue
 
 
 CLEAR = Color(0,0,0)
@@ -23,8 +35,95 @@ YELLOW = Color(255,255,0)
 WHITE = Color(255,255,255)
 ORANGE = Color(255,165,0)
 
+
+# Backends are what Strip pushes frames to. They have the methods of
+# rpi_ws281x.Adafruit_NeoPixel that Strip uses: begin(), numPixels(),
+# setPixelColor(i, colour) and show().
+
+def Ws281xBackend(count, pin, freq_hz, dma, invert, brightness, channel):
+    """The LED strip on the board."""
+    from rpi_ws281x import Adafruit_NeoPixel  # only installed on the board
+    return Adafruit_NeoPixel(count, pin, freq_hz, dma, invert, brightness, channel)
+
+
+class RecorderBackend:
+    """
+    In memory LED strip that keeps every frame pushed to it with its time,
+    to measure LED throughput and latency off the board. onset() marks
+    when a note was struck, see report().
+    """
+    def __init__(self, num_pixels=24, clock=time.perf_counter):
+        self.clock = clock
+        self.pixels = [CLEAR] * num_pixels
+        self.times = []   # time of each frame
+        self.frames = []  # pixels of each frame
+        self.onsets = []
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return len(self.pixels)
+
+    def setPixelColor(self, led, colour):
+        self.pixels[led] = colour
+
+    def show(self):
+        self.times.append(self.clock())
+        self.frames.append(tuple(self.pixels))
+
+    def onset(self, timestamp):
+        self.onsets.append(timestamp)
+
+    def report(self, updates=None, max_latency=1.0):
+        """
+        Parameters:
+          updates (int): logical updates the strip was given, Strip.updates
+          max_latency (float): a frame later than this after an onset is not a response to it
+        Returns:
+          report (dict): frames, frames per second, pushes per update and the
+                         time from each onset to the next frame pushed
+        """
+        span = self.times[-1] - self.times[0] if len(self.times) > 1 else 0
+        latencies = []
+        for i, onset in enumerate(self.onsets):
+            j = bisect.bisect_left(self.times, onset)
+            next_onset = self.onsets[i + 1] if i + 1 < len(self.onsets) else float("inf")
+            if j < len(self.times) and self.times[j] < next_onset and self.times[j] - onset <= max_latency:
+                latencies.append(self.times[j] - onset)
+        latencies.sort()
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4) if latencies else None
+
+        return {
+            "frames": len(self.times),
+            "fps": round((len(self.times) - 1) / span, 1) if span > 0 else None,
+            "updates": updates,
+            "pushes_per_update": round(len(self.times) / updates, 3) if updates else None,
+            "onsets": len(self.onsets),
+            "onset_to_led": {"count": len(latencies), "p50": percentile(0.5),
+                             "p95": percentile(0.95), "max": percentile(1.0)},
+        }
+
+
 class Strip:
-    def __init__(self):
+    """
+    LED strip driven by a background render thread.
+
+    The methods below only change a frame buffer and return. The renderer
+    diffs the buffer against the last frame it pushed, writes the changed
+    pixels and calls show() once, at most every FRAME_INTERVAL seconds, so a
+    burst of updates costs one push. Animations are effects, generators of
+    (pixels, seconds) frames the renderer steps through and draws over the
+    buffer. Note feedback interrupts a running effect, anything else shows
+    once the effect is done.
+
+    backend defaults to the ws281x strip. With threaded=False there is no
+    render thread and the owner calls tick() instead, replays do that once
+    per block so everything runs on the stream clock.
+    """
+    def __init__(self, backend=None, clock=time.perf_counter, threaded=True):
         self.LED_COUNT      = 24     # Number of LED pixels.
         self.LED_PIN        = 13      # GPIO pin connected to the pixels (18 uses PWM!).
         self.LED_FREQ_HZ    = 800000  # LED signal frequency in hertz (usually 800khz)
@@ -37,24 +136,124 @@ class Strip:
         self.QUARTER = [YELLOW, GREEN]
         self.HALF = [BLUE, CYAN]
         self.WHOLE = [VIOLET, MAGENTA]
-        self.strip = Adafruit_NeoPixel(self.LED_COUNT, self.LED_PIN, self.LED_FREQ_HZ, self.LED_DMA, self.LED_INVERT, self.LED_BRIGHTNESS, self.LED_CHANNEL)
+        if backend is None:
+            backend = Ws281xBackend(self.LED_COUNT, self.LED_PIN, self.LED_FREQ_HZ, self.LED_DMA, self.LED_INVERT, self.LED_BRIGHTNESS, self.LED_CHANNEL)
+        self.strip = backend
         self.strip.begin()
+        self.clock = clock
 
+        self.num_pixels = self.strip.numPixels()
+        self.frame = [CLEAR] * self.num_pixels  # what the LEDs should show
+        self.pushed = [None] * self.num_pixels  # what they show, None until the first push
+        self.effect = None  # running animation
+        self.effect_pixels = None
+        self.effect_due = 0  # when the effect's next frame is due
+        self.dirty = True
+        self.running = True
+        self.updates = 0  # calls to update() and play()
+        self.cond = threading.Condition()
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self.render, daemon=True)
+            self.thread.start()
 
-    def blinkLED(self, led):
-        self.strip.setPixelColor(led, BLUE)
+    def show(self):
+        # push the frame to the LEDs, timed for the /metrics endpoint
+        start = time.perf_counter()
         self.strip.show()
-        time.sleep(0.5)
-        self.strip.setPixelColor(led, CLEAR)
-        self.strip.show()
-        time.sleep(0.5)
+        METRICS.record("led_show", time.perf_counter() - start)
+
+    def render(self):
+        """Render thread: pushes the frame buffer, or the effect frame, when it changes."""
+        while True:
+            with self.cond:
+                while self.running and not self.dirty and (
+                        self.effect is None or self.clock() < self.effect_due):
+                    self.cond.wait(None if self.effect is None else self.effect_due - self.clock())
+            if not self.tick():
+                break
+            time.sleep(FRAME_INTERVAL)  # updates arriving meanwhile go out together
+
+    def tick(self):
+        """
+        One render step: advances the effect and pushes what changed
+        Returns:
+          running (bool): False once close() was called
+        """
+        with self.cond:
+            now = self.clock()
+            # frames that are already over are skipped, the effect keeps its pace
+            while self.effect is not None and now >= self.effect_due:
+                try:
+                    self.effect_pixels, seconds = next(self.effect)
+                    self.effect_due += seconds
+                except StopIteration:
+                    self.effect = None
+            pixels = list(self.frame if self.effect is None else self.effect_pixels)
+            self.dirty = False
+            running = self.running
+        self.push(pixels)
+        return running
+
+    def push(self, pixels):
+        changed = False
+        for i, colour in enumerate(pixels):
+            if colour != self.pushed[i]:
+                self.strip.setPixelColor(i, colour)
+                changed = True
+        if changed:
+            self.show()
+            self.pushed = pixels
+
+    def update(self, pixels, interrupt=False):
+        """Sets {led: colour} in the frame buffer, interrupt stops a running effect."""
+        with self.cond:
+            for led, colour in pixels.items():
+                self.frame[led] = colour
+            if interrupt:
+                self.effect = None
+            self.dirty = True
+            self.updates += 1
+            self.cond.notify()
+
+    def play(self, effect):
+        """Starts an effect, replacing a running one."""
+        with self.cond:
+            self.effect = effect
+            self.effect_due = self.clock()
+            self.updates += 1
+            self.cond.notify()
+
+    def close(self):
+        """Stops any effect, pushes the frame buffer one last time and stops the renderer."""
+        with self.cond:
+            self.effect = None
+            self.running = False
+            self.cond.notify()
+        if self.thread is None:
+            self.tick()
+        else:
+            self.thread.join()
+
+    def blinkLED(self, led):
+        self.update({led: CLEAR})
+        self.play(self.blinkFrames(led))
+
+    def blinkFrames(self, led):
+        with self.cond:
+            pixels = list(self.frame)
+        pixels[led] = BLUE
+        yield pixels, 0.5
+        pixels = list(pixels)
+        pixels[led] = CLEAR
+        yield pixels, 0.5
 
     def turnOnLED(self, led, note_type="q"):
+        pixels = {}
         c = Color(0, 255, 0)
         if self.LED_ON != -1:
             #turn off last led
-            self.strip.setPixelColor(self.LED_ON, Color(0,0,0))
-            self.strip.show()
+            pixels[self.LED_ON] = Color(0,0,0)
 
         if self.LED_ON == led:
             #same note as last time
@@ -78,31 +277,27 @@ class Strip:
             else:
                 c =  Color(0, 255, 0)
 
-        self.strip.setPixelColor(led, c)
-        self.strip.show()
+        pixels[led] = c
+        self.update(pixels, interrupt=True)
         self.LED_ON = led
 
     def turnOnLED_SOLO(self, led, set):
         #TO DO
         if led:
             if set == True:
-                self.strip.setPixelColor(led, RED)
+                self.update({led: RED}, interrupt=True)
             else:
-                self.strip.setPixelColor(led, CLEAR)
-            self.strip.show()
-        print("turn red")
+                self.update({led: CLEAR}, interrupt=True)
+        log.debug("Wrong note LED %s %s", led, "on" if set else "off")
 
     def show_ON(self):
-        self.strip.setPixelColor(23, GREEN)
-        self.strip.show()
+        self.update({23: GREEN})
 
     def showIndicator(self, led):
-        self.strip.setPixelColor(led, ORANGE)
-        self.strip.show() 
+        self.update({led: ORANGE})
     
     def turn_OFF(self, led):
-        self.strip.setPixelColor(led, CLEAR)
-        self.strip.show()
+        self.update({led: CLEAR})
 
     def wheel(self, pos):
         """Generate rainbow colors across 0-255 positions."""
@@ -117,31 +312,21 @@ class Strip:
 
     def rainbow(self, wait_ms=20, iterations=1):
         """Draw rainbow that fades across all pixels at once."""
+        self.play(self.rainbowFrames(wait_ms, iterations))
+
+    def rainbowFrames(self, wait_ms=20, iterations=1):
         for j in range(256*iterations):
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i, self.wheel((i+j) & 255))
-            self.strip.show()
-            time.sleep(wait_ms/1000.0)   
+            yield [self.wheel((i+j) & 255) for i in range(self.num_pixels)], wait_ms/1000.0
 
     def colourWipe(self):
-        for i in range(self.strip.numPixels()):
-            self.strip.setPixelColor(i, Color(0,0,0))
-            self.strip.show()
+        self.update({i: CLEAR for i in range(self.num_pixels)})
 
     def startSeq(self, led):
-        for i in range(self.strip.numPixels()):
-            self.strip.setPixelColor(i, Color(0,0,0))
-            self.strip.show()
-
-        self.rainbow()
-        for i in range(self.strip.numPixels()):
-            self.strip.setPixelColor(i, Color(0,0,0))
-            self.strip.show()
+        # the first note lights up once the rainbow is done
+        self.colourWipe()
         self.turnOnLED(led)
+        self.rainbow()
     
     def endSeq(self):
         self.rainbow()
         self.colourWipe()
-
-str = Strip()
-str.rainbow(1)
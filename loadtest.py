@@ -0,0 +1,168 @@
+import argparse
+import importlib.util
+import json
+import os
+import threading
+import time
+
+import requests
+
+# usage: python3 loadtest.py [--waiters 200] [--url http://192.168.4.1:5000]
+#        python3 loadtest.py --clients 16 [--rounds 50]
+# Without --url the server runs in this process, on a free local port.
+
+
+def local_server():
+    """Serves wifi-server.py's app from a thread, returns its url and the server."""
+    from werkzeug.serving import make_server
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wifi-server.py")
+    spec = importlib.util.spec_from_file_location("wifi_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    server = make_server("127.0.0.1", 0, module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p * len(values)))], 4)
+
+
+def run(url, waiters, posts, interval, settle):
+    """
+    Parks `waiters` long polls on /send_json, then posts `posts` feedbacks
+    Returns:
+      result (dict): how many polls got feedback and how long after it was posted
+    """
+    results = []  # (status, seconds from the post to the response) per waiter
+    lock = threading.Lock()
+
+    def wait():
+        try:
+            response = requests.get(f"{url}/send_json", timeout=60)
+            received = time.time()
+            latency = None
+            if response.status_code == 200:
+                latency = received - response.json()[0]["sent"]
+            status = response.status_code
+        except requests.RequestException as e:
+            status, latency = type(e).__name__, None
+        with lock:
+            results.append((status, latency))
+
+    threads = [threading.Thread(target=wait, daemon=True) for _ in range(waiters)]
+    for thread in threads:
+        thread.start()
+    time.sleep(settle)  # let the polls reach the server
+    server_threads = threading.active_count()
+
+    with requests.Session() as session:
+        for i in range(posts):
+            session.post(f"{url}/send_feedback", json=[{"seq": i, "sent": time.time()}], timeout=10)
+            time.sleep(interval)
+    for thread in threads:
+        thread.join()
+
+    latencies = [latency for status, latency in results if latency is not None]
+    statuses = {}
+    for status, latency in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "waiters": waiters,
+        "posts": posts,
+        "statuses": statuses,
+        "delivered": len(latencies),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_max": percentile(latencies, 1.0),
+        "threads_while_waiting": server_threads,
+    }
+
+
+def run_sessions(url, clients, rounds):
+    """
+    Each of `clients` threads is a phone with its own session: it posts a
+    feedback and takes it back from /send_json, `rounds` times, over a
+    kept-alive connection
+    Returns:
+      result (dict): request throughput, latency percentiles and how many
+                     responses had another client's feedback in them
+    """
+    latencies = []
+    mismatched = [0]
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def client(i):
+        own, wrong, failed = [], 0, 0
+        headers = {"X-Session-ID": f"loadtest-{i}"}
+        with requests.Session() as session:
+            barrier.wait()
+            for r in range(rounds):
+                try:
+                    start = time.perf_counter()
+                    response = session.post(f"{url}/send_feedback", json=[{"client": i, "round": r}],
+                                            headers=headers, timeout=10)
+                    own.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    response = session.get(f"{url}/send_json", headers=headers, timeout=30)
+                    own.append(time.perf_counter() - start)
+                    if response.status_code != 200 or response.json() != [{"client": i, "round": r}]:
+                        wrong += 1
+                except requests.RequestException:
+                    failed += 1
+        with lock:
+            latencies.extend(own)
+            mismatched[0] += wrong
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    return {
+        "clients": clients,
+        "rounds": rounds,
+        "requests": len(latencies),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(latencies) / seconds, 1),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": percentile(latencies, 1.0),
+        "mismatched": mismatched[0],
+        "errors": errors[0],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of /send_json and /send_feedback")
+    parser.add_argument("--url", help="server to test, default: run wifi-server.py's app in this process")
+    parser.add_argument("--waiters", type=int, default=100, help="concurrent /send_json polls")
+    parser.add_argument("--posts", type=int, help="feedbacks to post, default one per waiter")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between posts")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds between starting the polls and the first post")
+    parser.add_argument("--clients", type=int, help="run the multi-session test with this many clients instead")
+    parser.add_argument("--rounds", type=int, default=50, help="feedbacks each client posts and takes back")
+    args = parser.parse_args()
+
+    url = args.url
+    server = None
+    if url is None:
+        url, server = local_server()
+    if args.clients:
+        result = run_sessions(url, args.clients, args.rounds)
+    else:
+        result = run(url, args.waiters, args.posts or args.waiters, args.interval, args.settle)
+    print(json.dumps(result, indent=2))
+    if server:
+        server.shutdown()
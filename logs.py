@@ -0,0 +1,65 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+LOG_MAX_BYTES = 1_000_000 # a log file is rotated at this size
+LOG_BACKUPS = 3 # rotated files kept, player.log.1 ... player.log.3
+
+
+class RateLimit(logging.Filter):
+    """
+    Lets a log call through at most once every `interval` seconds, per line of
+    code, for logging from the audio path. The next message that gets
+    through says how many were dropped.
+    """
+    def __init__(self, interval=1.0):
+        super().__init__()
+        self.interval = interval
+        self.last = {} # (file, line) -> (time let through, dropped since)
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        last, dropped = self.last.get(key, (None, 0))
+        if last is not None and record.created - last < self.interval:
+            self.last[key] = (last, dropped + 1)
+            return False
+        self.last[key] = (record.created, 0)
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} more in the last {record.created - last:.1f}s)"
+        return True
+
+
+def setup_logging(path, debug=False, console=True, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """
+    Routes all logging through a queue. Calling threads (the audio callback,
+    request handlers) only put the record on the queue, a listener thread
+    formats it and writes it to `path` and the console.
+    Parameters:
+      path (str): log file, rotated at max_bytes
+      debug (bool): log DEBUG messages too, INFO and up otherwise
+      console (bool): also write to stderr
+    Returns:
+      listener (logging.handlers.QueueListener): already started, and stopped at
+        exit, which writes out what is still queued. Don't stop it twice
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)]
+    if console:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
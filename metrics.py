@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class Histogram:
+    """Rolling window of durations in seconds, summarised on demand."""
+    def __init__(self, size=512, deadline=None):
+        self.samples = deque(maxlen=size)
+        self.deadline = deadline  # durations above this count as misses
+        self.count = 0
+        self.misses = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+        if self.deadline is not None and seconds > self.deadline:
+            self.misses += 1
+
+    def summary(self):
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+        return {
+            "count": self.count,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": self.max,
+            "deadline": self.deadline,
+            "deadline_misses": self.misses,
+        }
+
+
+class Metrics:
+    """Named stage histograms. record() is cheap enough for the audio path."""
+    def __init__(self, size=512):
+        self.size = size
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def stage(self, name, deadline=None):
+        with self.lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram(self.size, deadline)
+            elif deadline is not None:
+                histogram.deadline = deadline
+            return histogram
+
+    def record(self, name, seconds):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stage(name)
+        histogram.add(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_laps(self, laps):
+        for name, seconds in laps:
+            self.record(name, seconds)
+
+    def snapshot(self):
+        with self.lock:
+            stages = {name: histogram.summary() for name, histogram in self.stages.items()}
+        return {"time": time.time(), "uptime": time.time() - self.started,
+                "stages": stages, "counters": dict(self.counters)}
+
+    def write(self, path):
+        """Writes snapshot() as json, atomically so readers never see half a file."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(tmp_path, path)
+
+
+class Stopwatch:
+    """
+    Times consecutive stages of one frame. lap() only appends to a list, the
+    laps are handed to Metrics.record_laps() once the frame is done (possibly
+    in another process). Laps outside start()/drain() are ignored.
+    """
+    def __init__(self):
+        self.laps = []
+        self.last = None
+
+    def start(self):
+        self.laps = []
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        if self.last is None:
+            return
+        now = time.perf_counter()
+        self.laps.append((name, now - self.last))
+        self.last = now
+
+    def drain(self):
+        laps = self.laps
+        self.laps = []
+        self.last = None
+        return laps
+
+
+def prometheus_text(snapshot, prefix="fydp_stage"):
+    """
+    Renders a snapshot() in the Prometheus text exposition format. Its
+    "counters" become fydp_<name>_total counters, an optional "gauges" dict
+    fydp_<name> gauges.
+    """
+    lines = [
+        f"# HELP {prefix}_seconds Rolling duration quantiles per pipeline stage.",
+        f"# TYPE {prefix}_seconds summary",
+    ]
+    for name, summary in sorted(snapshot.get("stages", {}).items()):
+        for quantile in ("p50", "p95", "p99"):
+            lines.append(f'{prefix}_seconds{{stage="{name}",quantile="0.{quantile[1:]}"}} {summary[quantile]:.6f}')
+        lines.append(f'{prefix}_seconds_count{{stage="{name}"}} {summary["count"]}')
+    lines.append(f"# TYPE {prefix}_max_seconds gauge")
+    for name, summary in sorted(snapshot.get("stages", {}).items()):
+        lines.append(f'{prefix}_max_seconds{{stage="{name}"}} {summary["max"]:.6f}')
+    lines.append(f"# TYPE {prefix}_deadline_misses_total counter")
+    for name, summary in sorted(snapshot.get("stages", {}).items()):
+        if summary.get("deadline") is not None:
+            lines.append(f'{prefix}_deadline_misses_total{{stage="{name}"}} {summary["deadline_misses"]}')
+    for name, value in sorted(snapshot.get("counters", {}).items()):
+        lines.append(f"# TYPE fydp_{name}_total counter")
+        lines.append(f"fydp_{name}_total {value}")
+    for name, value in sorted(snapshot.get("gauges", {}).items()):
+        lines.append(f"# TYPE fydp_{name} gauge")
+        lines.append(f"fydp_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()  # the process wide registry
@@ -0,0 +1,74 @@
+from collections import deque
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class OnsetDetector:
+    """
+    Streaming spectral flux onset detector.
+
+    Each block is cut into short overlapping frames. The flux of a frame is the
+    summed increase of its log magnitude spectrum over the previous frame, and
+    an onset is reported when it rises above an adaptive threshold (a multiple
+    of the median flux before the block plus a fixed floor), at most once per
+    min_interval. State carries over between blocks, so the block size does
+    not matter.
+    """
+    def __init__(self, sample_freq=48000, frame_size=1024, hop_size=512, ratio=1.5,
+                 delta=0.05, history=1.0, min_interval=0.2, compression=100, max_freq=6000):
+        self.sample_freq = sample_freq
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        self.ratio = ratio
+        self.delta = delta
+        self.compression = compression  # log(1 + compression*magnitude) evens out loud and soft notes
+        self.min_interval = int(min_interval * sample_freq)
+        self.bins = min(frame_size // 2 + 1, int(max_freq * frame_size / sample_freq) + 1)
+
+        self.window = np.hanning(frame_size)
+        self.pending = np.zeros(0)  # samples not yet covered by a full frame
+        self.previous = None  # log magnitude of the last frame
+        self.flux = deque(maxlen=max(1, int(history * sample_freq / hop_size)))
+        self.position = 0  # stream index of self.pending[0]
+        self.last_onset = -self.min_interval
+        self.above = False  # flux was over the threshold on the previous frame
+
+    def process(self, samples):
+        """
+        Parameters:
+          samples (np.ndarray): the next block of the stream
+        Returns:
+          onsets (list): seconds from each onset in the block to the end of the block
+        """
+        data = np.concatenate((self.pending, samples))
+        end = self.position + len(data)
+        num_frames = (len(data) - self.frame_size) // self.hop_size + 1
+        onsets = []
+        if num_frames > 0:
+            frames = sliding_window_view(data, self.frame_size)[::self.hop_size][:num_frames]
+            spectra = np.abs(np.fft.rfft(frames * self.window, axis=1)[:, :self.bins])
+            log_spectra = np.log1p(self.compression * spectra)
+
+            previous = log_spectra[:1] if self.previous is None else self.previous[np.newaxis, :]
+            rises = np.diff(log_spectra, axis=0, prepend=previous)
+            flux = np.maximum(rises, 0).mean(axis=1)
+            self.previous = log_spectra[-1]
+
+            # the threshold follows the flux history up to the start of the block
+            threshold = self.ratio * np.median(self.flux) + self.delta if self.flux else self.delta
+            self.flux.extend(flux)
+            for i in np.flatnonzero(flux > threshold):
+                onset_at = self.position + i * self.hop_size + self.frame_size  # end of the frame
+                rising = i == 0 and not self.above or i > 0 and flux[i - 1] <= threshold
+                if rising and onset_at - self.last_onset >= self.min_interval:
+                    self.last_onset = onset_at
+                    onsets.append(float(end - onset_at) / self.sample_freq)
+            self.above = flux[-1] > threshold
+
+            consumed = num_frames * self.hop_size
+            self.pending = data[consumed:]
+            self.position += consumed
+        else:
+            self.pending = data
+        return onsets
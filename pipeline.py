@@ -0,0 +1,204 @@
+import heapq
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+
+from metrics import METRICS
+
+DROPPED = "DROPPED"  # result of a frame that was too old to analyse
+EXPECTED_NOTES = 2  # expected notes shared with the workers, see Listener.expected
+
+
+class SharedRing:
+    """
+    Mirrored sample ring (see ring_buffer.RingBuffer) in shared memory.
+
+    One writer, the audio callback, and any number of reader processes.
+    Samples are addressed by their absolute index since the stream started,
+    so a reader can check after the fact whether the writer has lapped the
+    window it was looking at.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.shared = mp.RawArray('f', 2 * capacity)  # float32 like the input stream
+        self.written = mp.RawValue('q', 0)  # samples written since the start
+        self.data = np.frombuffer(self.shared, dtype=np.float32)
+
+    def __getstate__(self):
+        # a worker gets the shared memory, not a copy of the view
+        return {"capacity": self.capacity, "shared": self.shared, "written": self.written}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.frombuffer(self.shared, dtype=np.float32)
+
+    def extend(self, samples):
+        n = len(samples)
+        pos = self.written.value % self.capacity
+        first = min(n, self.capacity - pos)
+        self.data[pos:pos + first] = samples[:first]
+        self.data[pos + self.capacity:pos + self.capacity + first] = samples[:first]
+        if first < n:
+            rest = n - first
+            self.data[:rest] = samples[first:]
+            self.data[self.capacity:self.capacity + rest] = samples[first:]
+        self.written.value += n
+        return self.written.value
+
+    def window(self, end, length):
+        """View of the `length` samples before absolute index `end`."""
+        start = (end - length) % self.capacity
+        return self.data[start:start + length]
+
+    def lapped(self, end, length):
+        """True if the window ending at `end` has been (partly) overwritten."""
+        return self.written.value - end > self.capacity - length
+
+
+def analysis_worker(detector, ring, frames, results, expected, max_lag):
+    """Worker process: detects the notes of the frames announced on `frames` and posts the results."""
+    length = detector.window_size
+    expected = np.frombuffer(expected, dtype=np.float64)
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        seq, end, pushed, signal_power = frame
+
+        # bounded latency: skip frames that newer audio has already superseded
+        if ring.written.value - end > max_lag:
+            results.put((seq, None, DROPPED, [], pushed))
+            continue
+
+        detector.stopwatch.start()
+        closest_note, _ = detector.detect(ring.window(end, length), expected)
+        laps = detector.stopwatch.drain()
+        if ring.lapped(end, length):
+            closest_note = DROPPED
+        results.put((seq, signal_power, closest_note, laps, pushed))
+
+
+class AnalysisPipeline:
+    """
+    Runs the listener's pitch detection in worker processes, outside the PortAudio callback.
+
+    push() only runs the O(block) silence gate, copies the block into a shared
+    memory ring and announces the new frame, so the callback returns quickly. Workers pick up frames in
+    parallel, one per core, and drop frames that are more than `max_lag` blocks
+    old. A thread in this process puts the results back in stream order and
+    hands them to Listener.handle(), which drives the state machine and LEDs.
+    The attacks push() hears stay in this process and go to the state
+    machine in order too, also for frames that are dropped.
+
+    The player has threads running by the time a song starts (LEDs, logging,
+    uploads), so workers are not forked from it: they come from a fork
+    server, a clean process, and get a copy of the detector only.
+    """
+    def __init__(self, listener, window_step, workers=3, max_lag=2):
+        self.listener = listener
+        self.window_step = window_step
+        self.num_workers = workers
+        # room for the window plus the frames that may still be in flight
+        self.ring = SharedRing(listener.detector.window_size + (max_lag + workers + 1) * window_step)
+        self.max_lag = max_lag * window_step
+        self.context = mp.get_context("forkserver")
+        self.context.set_forkserver_preload(["pipeline", "pitch"])  # imported once, not per worker
+        self.frames = self.context.Queue()
+        self.results = self.context.Queue()
+        # frequencies of the expected notes, 0 for none
+        self.expected = self.context.RawArray('d', EXPECTED_NOTES)
+        self.seq = 0
+        self.onsets = {}  # seq -> attack time of the frames in flight that had one
+        self.dropped = 0
+        self.processes = []
+        self.thread = None
+
+    def share_expected(self):
+        expected = self.listener.expected[:EXPECTED_NOTES]
+        for i in range(EXPECTED_NOTES):
+            self.expected[i] = expected[i] if i < len(expected) else 0
+
+    def start(self):
+        self.share_expected()
+        for _ in range(self.num_workers):
+            process = self.context.Process(target=analysis_worker, daemon=True,
+                                           args=(self.listener.detector, self.ring, self.frames, self.results,
+                                                 self.expected, self.max_lag))
+            process.start()
+            self.processes.append(process)
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+
+    def push(self, samples):
+        """Called from the audio callback with each new block."""
+        now = time.perf_counter()
+        length = self.listener.detector.window_size
+        written = self.ring.written.value
+        outgoing = self.ring.window(written - length + len(samples), len(samples))
+        signal_power, silent, onset = self.listener.measure(samples, outgoing)
+        end = self.ring.extend(samples)
+        if onset is not None:
+            self.onsets[self.seq] = onset
+        if silent:
+            # nothing to analyse, straight to the collector
+            self.results.put((self.seq, signal_power, "SILENCE", [], now))
+        else:
+            self.frames.put((self.seq, end, now, signal_power))
+        self.seq += 1
+
+    def drop(self, seq):
+        self.dropped += 1
+        METRICS.count("dropped_frames")
+        onset = self.onsets.pop(seq, None)
+        if onset is not None:
+            self.listener.state_machine.handle_input("ONSET", onset)  # the attack still happened
+
+    def collect(self):
+        """Hands results to the listener in stream order."""
+        pending = []
+        next_seq = 0
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            heapq.heappush(pending, result)
+            # a worker can only be behind by the frames in flight, don't wait longer than that
+            if len(pending) > self.num_workers + 1:
+                for seq in range(next_seq, pending[0][0]):
+                    METRICS.count("late_frames")
+                    self.drop(seq)
+                next_seq = max(next_seq, pending[0][0])
+            while pending and pending[0][0] <= next_seq:
+                seq, signal_power, closest_note, laps, pushed = heapq.heappop(pending)
+                if seq < next_seq:
+                    continue  # given up on and counted as dropped already
+                next_seq = seq + 1
+                if closest_note == DROPPED:
+                    self.drop(seq)
+                    continue
+                METRICS.record_laps(laps)
+                self.listener.handle(signal_power, closest_note, self.onsets.pop(seq, None))
+                self.share_expected()
+                # from the callback handing over the block to the state machine being done
+                METRICS.record("frame", time.perf_counter() - pushed)
+
+    def stop(self):
+        for _ in self.processes:
+            self.frames.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.results.put(None)
+        if self.thread:
+            self.thread.join(timeout=1)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,388 @@
+import numpy as np
+import scipy.fft
+
+from metrics import Stopwatch
+
+ALL_NOTES = ["A","A#","B","C","C#","D","D#","E","F","F#","G","G#"]
+A4_NUMBER = 69 # midi number of a4, the concert pitch
+OCTAVE_BANDS = [50, 100, 200, 400, 800, 1600, 3200, 6400, 12800, 25600]
+
+
+def find_closest_note(pitch, concert_pitch=440):
+    """
+    This function finds the closest note for a given pitch
+    Parameters:
+      pitch (float): pitch given in hertz
+      concert_pitch (float): pitch of a4 in hertz
+    Returns:
+      closest_note (str): e.g. a, g#, ..
+      closest_pitch (float): pitch of the closest note in hertz
+    """
+    i = int(np.round(np.log2(pitch/concert_pitch)*12))
+    closest_note = note_name(A4_NUMBER + i)
+    closest_pitch = concert_pitch*2**(i/12)
+    return closest_note, closest_pitch
+
+
+def note_number(note):
+    """Midi number of a note name such as "C#4", -1 for None."""
+    if not note:
+        return -1
+    j = ALL_NOTES.index(note[:-1])
+    octave = int(note[-1])
+    return A4_NUMBER + j + 12 * (octave - 4 - (j + 9) // 12)
+
+
+def note_name(number):
+    """Note name of a midi number, the inverse of note_number, None for -1."""
+    if number < 0:
+        return None
+    i = number - A4_NUMBER
+    return ALL_NOTES[i % 12] + str(4 + (i + 9) // 12)
+
+
+def note_frequency(note, concert_pitch=440):
+    """Pitch in hertz of a note name such as "C#4", the inverse of find_closest_note."""
+    return concert_pitch*2**((note_number(note) - A4_NUMBER)/12)
+
+
+class PitchDetector:
+    """
+    Harmonic product spectrum pitch detector.
+
+    The spectral path runs in float32. All work buffers are allocated once
+    in __init__ and every stage of detect() after the FFT writes into them
+    in place, so running it on the audio thread barely allocates per block.
+
+    set_range() limits the search to the notes that can be played, so only
+    the bins needed for their harmonics are processed, and detect() can be
+    given the notes it expects to try a cheap harmonic check before the
+    full HPS search.
+    """
+    def __init__(self, sample_freq=48000, window_size=48000, num_hps=5,
+                 concert_pitch=440, white_noise_thresh=0.2, hum_freq=62,
+                 octave_bands=OCTAVE_BANDS, match_ratio=0.6, fundamental_ratio=0.1,
+                 sub_octave_ratio=0.2, fft_workers=1):
+        self.sample_freq = sample_freq
+        self.window_size = window_size
+        self.num_hps = num_hps
+        self.concert_pitch = concert_pitch
+        self.white_noise_thresh = white_noise_thresh
+        self.match_ratio = match_ratio  # share of the spectrum energy an expected note's harmonics need
+        self.fundamental_ratio = fundamental_ratio  # share of that its fundamental needs (rules out octaves)
+        self.sub_octave_ratio = sub_octave_ratio  # most the odd harmonics of freq/2 may have of that (rules out the octave below)
+        self.delta_freq = sample_freq / window_size
+        self.fft_workers = fft_workers  # threads per FFT, keep at 1 when several detectors share the cores
+
+        self.hann_window = np.hanning(window_size).astype(np.float32)
+        self.num_bins = window_size // 2
+        self.num_ipol = self.num_bins * num_hps
+
+        # bins zeroed for mains hum and the (start, end) bins of each octave band
+        self.hum_bins = int(hum_freq / self.delta_freq)
+        self.bands = []
+        for j in range(len(octave_bands)-1):
+            ind_start = int(octave_bands[j] / self.delta_freq)
+            ind_end = min(int(octave_bands[j+1] / self.delta_freq), self.num_bins)
+            if ind_end > ind_start:
+                self.bands.append((ind_start, ind_end))
+
+        # work buffers
+        self.frame = np.zeros(window_size, dtype=np.float32)   # windowed frame
+        self.magnitude = np.zeros(self.num_bins, dtype=np.float32)
+        self.power = np.zeros(self.num_bins, dtype=np.float32)  # magnitude squared over the bands
+        self.bin_thresh = np.zeros(self.num_bins, dtype=np.float32)  # noise threshold of each bin
+        self.band_mask = np.zeros(self.num_bins, dtype=bool)
+        self.slope = np.zeros(self.num_bins, dtype=np.float32)  # magnitude[i+1] - magnitude[i]
+        self.mag_ipol = np.zeros(self.num_ipol, dtype=np.float32)
+        self.hps = np.zeros(self.num_ipol, dtype=np.float32)    # HPS accumulator
+        self.hps_tmp = np.zeros(self.num_ipol, dtype=np.float32)
+        # view of the interpolated spectrum with one column per interpolation step
+        self.ipol_steps = self.mag_ipol.reshape(self.num_bins, num_hps)
+
+        self.harmonic_bins = {}  # expected frequency -> bin ranges of its harmonics and of the octave below's odd ones
+        self.set_range(None, None)
+        self.stopwatch = Stopwatch()  # stage timings, the caller starts and drains it
+        # scipy.fft caches the plan for a transform size, build it now rather than on the first block
+        scipy.fft.rfft(self.frame, workers=self.fft_workers)
+
+    def set_range(self, min_freq, max_freq):
+        """Limits the search to fundamentals between min_freq and max_freq, None for no limit."""
+        if max_freq is None:
+            self.search = (0, self.num_ipol)
+            self.ipol_rows = self.num_bins
+            self.spec_bins = self.num_bins
+        else:
+            # the HPS search range in interpolated bins
+            k_lo = int(min_freq / self.delta_freq * self.num_hps) if min_freq else 0
+            k_hi = min(int(np.ceil(max_freq / self.delta_freq * self.num_hps)) + 1, self.num_ipol)
+            self.search = (k_lo, k_hi)
+            # the top harmonic of interpolated bin k lies in magnitude bin k
+            self.ipol_rows = min(k_hi + 1, self.num_bins)
+            # whole octave bands, so the noise threshold does not change
+            self.spec_bins = self.num_bins
+            for ind_start, ind_end in self.bands:
+                if ind_end > self.ipol_rows:
+                    self.spec_bins = ind_end
+                    break
+        self.active_bands = [band for band in self.bands if band[0] < self.spec_bins]
+        # the octave bands are contiguous, so per band sums are one reduceat over
+        # [band_lo, band_hi) and band_index maps each bin to its band
+        self.band_lo = self.active_bands[0][0]
+        self.band_hi = self.active_bands[-1][1]
+        self.band_offsets = np.array([start - self.band_lo for start, end in self.active_bands])
+        self.band_sizes = np.array([end - start for start, end in self.active_bands], dtype=np.float32)
+        self.band_index = np.repeat(np.arange(len(self.active_bands)), self.band_sizes.astype(int))
+        self.harmonic_bins = {}
+
+    def spectrum(self, samples):
+        """Fills self.magnitude with the noise suppressed magnitude spectrum of samples."""
+        # avoid spectral leakage by multiplying the signal with a hann window
+        np.multiply(samples, self.hann_window, out=self.frame, casting='unsafe')
+        spectrum = scipy.fft.rfft(self.frame, overwrite_x=True, workers=self.fft_workers)
+
+        # only the bins in use are converted
+        mag = self.magnitude
+        bins = self.spec_bins
+        np.abs(spectrum[:bins], out=mag[:bins])
+        self.stopwatch.lap("fft")
+
+        # supress mains hum, set everything below the hum frequency to zero
+        mag[:self.hum_bins] = 0
+
+        # calculate average energy per frequency for the octave bands
+        # and suppress everything below it
+        band = mag[self.band_lo:self.band_hi]
+        n = len(band)
+        power = self.power[:n]
+        np.multiply(band, band, out=power)
+        avg_energy_per_freq = np.sqrt(np.add.reduceat(power, self.band_offsets) / self.band_sizes)
+        thresh = self.bin_thresh[:n]
+        np.take(self.white_noise_thresh * avg_energy_per_freq, self.band_index, out=thresh)
+        mask = self.band_mask[:n]
+        np.greater(band, thresh, out=mask)
+        np.multiply(band, mask, out=band)  # cheaper than assigning through the mask
+        self.stopwatch.lap("noise")
+        return mag
+
+    def bin_ranges(self, multiples):
+        # a quarter tone either side of each frequency
+        ranges = []
+        for freq in multiples:
+            lo = int(freq * 2**(-1/24) / self.delta_freq)
+            hi = int(np.ceil(freq * 2**(1/24) / self.delta_freq)) + 1
+            if hi <= self.spec_bins:
+                ranges.append((lo, hi))
+        return ranges
+
+    def matches(self, freq, total_energy):
+        """
+        Fast path: True if the spectrum is dominated by the harmonics of freq.
+        The note an octave below has those too, as its even harmonics, so
+        the spectrum must also have little at the odd harmonics of freq/2.
+        """
+        if freq not in self.harmonic_bins:
+            self.harmonic_bins[freq] = (self.bin_ranges(h * freq for h in range(1, self.num_hps + 1)),
+                                        self.bin_ranges((h - 0.5) * freq for h in range(1, self.num_hps + 1)))
+        harmonics, sub_octave = self.harmonic_bins[freq]
+
+        mag = self.magnitude
+        captured = 0
+        fundamental = None
+        for lo, hi in harmonics:
+            energy = np.dot(mag[lo:hi], mag[lo:hi])
+            if fundamental is None:
+                fundamental = energy
+            captured += energy
+        if not (captured > 0 and captured >= self.match_ratio * total_energy
+                and fundamental >= self.fundamental_ratio * captured):
+            return False
+        below = sum(np.dot(mag[lo:hi], mag[lo:hi]) for lo, hi in sub_octave)
+        return below < self.sub_octave_ratio * captured
+
+    def interpolate(self):
+        """Linearly interpolates self.magnitude num_hps times finer into self.mag_ipol."""
+        mag = self.magnitude
+        rows = self.ipol_rows
+        if rows < self.num_bins:
+            np.subtract(mag[1:rows+1], mag[:rows], out=self.slope[:rows])
+        else:
+            np.subtract(mag[1:], mag[:-1], out=self.slope[:-1])
+            self.slope[-1] = 0  # np.interp holds the last value past the end
+        for j in range(self.num_hps):
+            column = self.ipol_steps[:rows, j]
+            np.multiply(self.slope[:rows], j / self.num_hps, out=column)
+            column += mag[:rows]
+
+        mag_ipol = self.mag_ipol[:rows*self.num_hps]
+        norm = np.sqrt(np.dot(mag_ipol, mag_ipol))
+        if norm > 0:
+            mag_ipol /= norm  # normalize it
+        return mag_ipol
+
+    def harmonic_product(self):
+        """
+        Returns the HPS of self.mag_ipol over the search range as a view into
+        the accumulator, and the interpolated bin of its first element.
+        """
+        k_lo, k_hi = self.search
+        length = self.ipol_rows * self.num_hps
+        mag_ipol = self.mag_ipol[:length]
+        hps, tmp = self.hps, self.hps_tmp
+        hps[k_lo:k_hi] = mag_ipol[k_lo:k_hi]
+        end = k_hi
+        for i in range(self.num_hps):
+            n = min(k_hi, int(np.ceil(length/(i+1))))
+            np.multiply(hps[k_lo:n], mag_ipol[::(i+1)][k_lo:n], out=tmp[k_lo:n])
+            if not tmp[k_lo:n].any():
+                break
+            hps, tmp = tmp, hps
+            end = n
+        return hps[k_lo:end], k_lo
+
+    def detect(self, samples, expected=()):
+        """
+        Detects the pitch of a window of samples
+        Parameters:
+          samples (np.ndarray): window_size samples
+          expected (list): frequencies of the notes most likely to be played, checked first
+        Returns:
+          closest_note (str): e.g. a, g#, ..
+          closest_pitch (float): pitch of the closest note in hertz
+        """
+        mag = self.spectrum(samples)
+        if len(expected):
+            total_energy = np.dot(mag[:self.spec_bins], mag[:self.spec_bins])
+            for freq in expected:
+                if freq and self.matches(freq, total_energy):
+                    self.stopwatch.lap("fast_path")
+                    closest_note, closest_pitch = find_closest_note(freq, self.concert_pitch)
+                    return closest_note, round(closest_pitch, 1)
+            self.stopwatch.lap("fast_path")
+
+        self.interpolate()
+        self.stopwatch.lap("interpolate")
+        hps_spec, offset = self.harmonic_product()
+        self.stopwatch.lap("hps")
+
+        max_ind = np.argmax(hps_spec) + offset
+        max_freq = max_ind * self.delta_freq / self.num_hps
+        closest_note, closest_pitch = find_closest_note(max_freq, self.concert_pitch)
+        return closest_note, round(closest_pitch, 1)
+
+
+class YinDetector:
+    """
+    YIN pitch detector for short frames.
+
+    Works in the time domain on a few thousand samples instead of a one
+    second spectrum, so a new note is reported much sooner than with the
+    HPS detector. detect() has the same interface as PitchDetector.detect()
+    but returns (None, None) for frames without a clear period.
+    """
+    def __init__(self, sample_freq=48000, window_size=4096, concert_pitch=440,
+                 threshold=0.2, aperiodic_thresh=0.4, min_freq=62, max_freq=2000, fft_workers=1):
+        self.sample_freq = sample_freq
+        self.fft_workers = fft_workers
+        self.window_size = window_size
+        self.concert_pitch = concert_pitch
+        self.threshold = threshold
+        self.aperiodic_thresh = aperiodic_thresh  # frames whose best dip is above this are unvoiced
+
+        self.tau_min = max(2, int(sample_freq / max_freq))
+        self.tau_max = min(int(np.ceil(sample_freq / min_freq)), window_size // 2)
+        self.integration = window_size - self.tau_max  # samples summed per lag
+        self.fft_size = 1 << int(np.ceil(np.log2(window_size + self.integration)))
+
+        # work buffers, float64 since d(tau) is a difference of large sums
+        self.frame = np.zeros(window_size)
+        self.head = np.zeros(self.fft_size)         # first `integration` samples, zero padded
+        self.energy = np.zeros(window_size + 1)     # cumulative energy of the frame
+        self.diff = np.zeros(self.tau_max)          # difference function d(tau)
+        self.cmnd = np.zeros(self.tau_max)          # cumulative mean normalised difference
+        self.taus = np.arange(self.tau_max, dtype=np.float64)
+        import scipy.signal  # slow to import, so only when yin is used
+        self.sosfilt = scipy.signal.sosfilt
+        self.hum_filter = scipy.signal.butter(4, min_freq * 1.5, 'highpass', fs=sample_freq, output='sos')
+        self.set_range(None, None)
+        self.stopwatch = Stopwatch()  # stage timings, the caller starts and drains it
+
+    def set_range(self, min_freq, max_freq):
+        """Limits the period search to fundamentals between min_freq and max_freq, None for no limit."""
+        self.search_lo = self.tau_min if max_freq is None else max(self.tau_min, int(self.sample_freq / max_freq))
+        self.search_hi = self.tau_max if min_freq is None else min(self.tau_max, int(np.ceil(self.sample_freq / min_freq)) + 1)
+
+    def difference(self, samples):
+        """d(tau) = sum (x[j] - x[j+tau])^2 over the integration window, via FFT autocorrelation."""
+        x = self.frame
+        # high pass so mains hum does not mask the period of low notes
+        x[:] = self.sosfilt(self.hum_filter, samples)
+        w = self.integration
+
+        np.cumsum(x * x, out=self.energy[1:])
+        self.head[:w] = x[:w]
+        spec_head = scipy.fft.rfft(self.head, workers=self.fft_workers)
+        spec = scipy.fft.rfft(x, self.fft_size, workers=self.fft_workers)
+        np.conjugate(spec_head, out=spec_head)
+        spec *= spec_head
+        corr = scipy.fft.irfft(spec, self.fft_size, overwrite_x=True, workers=self.fft_workers)[:self.tau_max]
+
+        energy_head = self.energy[w]
+        energy_lag = self.energy[w:w + self.tau_max] - self.energy[:self.tau_max]
+        np.add(energy_head, energy_lag, out=self.diff)
+        self.diff -= 2 * corr
+        np.maximum(self.diff, 0, out=self.diff)
+        return self.diff
+
+    def normalise(self):
+        """Cumulative mean normalised difference, d'(0) = 1."""
+        np.cumsum(self.diff, out=self.cmnd)
+        self.cmnd[0] = 1
+        self.cmnd[1:] = np.divide(self.diff[1:] * self.taus[1:], self.cmnd[1:],
+                                  out=np.ones(self.tau_max - 1), where=self.cmnd[1:] > 0)
+        return self.cmnd
+
+    def period(self):
+        """Returns the period in samples with sub sample precision, or None if unvoiced."""
+        cmnd = self.cmnd
+        lags = cmnd[self.search_lo:self.search_hi]
+        below = np.flatnonzero(lags < self.threshold)
+        if len(below) == 0:
+            # noisy frame: relax the threshold to just above the deepest dip, as long
+            # as that dip is clear enough, and still take the first (shortest) period
+            deepest = lags.min()
+            if deepest > self.aperiodic_thresh:
+                return None
+            below = np.flatnonzero(lags < deepest + 0.1)
+        tau = below[0] + self.search_lo
+        # walk down to the bottom of the dip
+        while tau + 1 < self.search_hi and cmnd[tau + 1] < cmnd[tau]:
+            tau += 1
+
+        # parabolic interpolation around the minimum
+        if 0 < tau < self.tau_max - 1:
+            a, b, c = cmnd[tau - 1], cmnd[tau], cmnd[tau + 1]
+            denom = a - 2 * b + c
+            if denom != 0:
+                return tau + 0.5 * (a - c) / denom
+        return float(tau)
+
+    def detect(self, samples, expected=()):
+        """
+        Detects the pitch of a window of samples
+        Parameters:
+          samples (np.ndarray): window_size samples
+          expected (list): unused, the period search is already cheap
+        Returns:
+          closest_note (str): e.g. a, g#, .. or None if no pitch was found
+          closest_pitch (float): pitch of the closest note in hertz or None
+        """
+        self.difference(samples)
+        self.normalise()
+        tau = self.period()
+        self.stopwatch.lap("yin")
+        if tau is None:
+            return None, None
+
+        closest_note, closest_pitch = find_closest_note(self.sample_freq / tau, self.concert_pitch)
+        return closest_note, round(closest_pitch, 1)
@@ -0,0 +1,90 @@
+import json
+import os
+import socket
+import threading
+from collections import deque
+
+from metrics import METRICS
+
+PROGRESS_SOCKET = "/tmp/fydp_progress.sock" # the server listens here for the player's note events
+
+
+class ProgressSender:
+    """
+    Player end of the live progress: sends each event to wifi-server.py as one
+    datagram of compact json. send() never blocks, it is called from the
+    audio path. An event the server isn't there to take is dropped, the
+    spooled feedback still has it.
+    """
+    def __init__(self, path=PROGRESS_SOCKET):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, event):
+        try:
+            self.sock.sendto(json.dumps(event, separators=(",", ":")).encode(), self.path)
+        except OSError:
+            METRICS.count("progress_dropped")
+
+    def close(self):
+        self.sock.close()
+
+
+class ProgressStream:
+    """
+    Server end: numbers the player's events and keeps the last `size` of
+    them, so a client that reconnects with the last sequence number it saw
+    gets what it missed. wait() blocks until there is something newer.
+    """
+    def __init__(self, path=PROGRESS_SOCKET, size=1024):
+        self.path = path
+        self.events = deque(maxlen=size) # (seq, json text)
+        self.seq = 0 # seq of the newest event
+        self.cond = threading.Condition()
+        if os.path.exists(path):
+            os.unlink(path) # left over from a server that didn't shut down cleanly
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o666) # the player may run as another user
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                break # closed
+            self.publish(data.decode())
+
+    def publish(self, text):
+        """Adds an event (json text) and wakes the waiting streams. Returns its seq."""
+        with self.cond:
+            self.seq += 1
+            self.events.append((self.seq, text))
+            self.cond.notify_all()
+            return self.seq
+
+    def since(self, seq):
+        # a seq from before a server restart is newer than anything here, start over
+        if seq > self.seq:
+            seq = 0
+        return [event for event in self.events if event[0] > seq]
+
+    def wait(self, seq, timeout=None):
+        """
+        Parameters:
+          seq (int): the last seq the client has
+          timeout (float): seconds to wait for a new event
+        Returns:
+          events (list): (seq, json text) newer than seq, empty on timeout
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.since(seq), timeout=timeout)
+            return self.since(seq)
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,146 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+import combo
+from feedback import read_feedback
+from led_control import RecorderBackend, Strip
+from metrics import METRICS
+from state import State
+
+# usage: python3 replay.py recording.wav --song song_no_app.json [--engine yin] [--out result.json]
+
+
+class StreamClock:
+    """Time of the replayed stream in seconds, advanced block by block."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Timeline:
+    """
+    Sits between the listener and the state machine and records every input.
+    Onsets are also marked on the LED recorder, at the time of the attack.
+    """
+    def __init__(self, state_machine, clock, leds):
+        self.state_machine = state_machine
+        self.clock = clock
+        self.leds = leds
+        self.events = []  # [time, note] whenever the input changes
+
+    def handle_input(self, played_note, when=None):
+        if not self.events or self.events[-1][1] != played_note:
+            self.events.append([round(self.clock(), 3), played_note])
+        if played_note == "ONSET":
+            self.leds.onset(when)
+        self.state_machine.handle_input(played_note, when)
+
+
+def read_wav(path):
+    """Returns the first channel of a PCM wav file as float32 in [-1, 1] and its sample rate."""
+    with wave.open(path, 'rb') as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+
+    if width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 2**15
+    elif width == 4:
+        samples = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2**31
+    else:
+        raise ValueError(f"Unsupported sample width: {width} bytes")
+    return samples[::channels], rate
+
+
+def replay(wav_paths, song_data, engine=combo.PITCH_ENGINE):
+    """
+    Streams recordings through combo.callback as fast as possible
+    Parameters:
+      wav_paths (list): recordings, played back to back
+      song_data (dict): song json as sent by the app
+      engine (str): pitch engine, see combo.make_detector
+    Returns:
+      result (dict): feedback, played notes, detected note timeline, LED and detection throughput
+    """
+    clock = StreamClock()
+    blocks = 0
+    feedback_dir = tempfile.TemporaryDirectory()
+    feedback_path = os.path.join(feedback_dir.name, "feedback.jsonl")
+    # keep anything printed along the way out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        leds = RecorderBackend(clock=clock)
+        strip = Strip(leds, clock=clock, threaded=False)
+        combo.setup(strip, engine, clock=clock, feedback_path=feedback_path)
+        timeline = Timeline(combo.state_machine, clock, leds)
+        combo.listener.state_machine = timeline
+        combo.songs.setSong(song_data)
+        combo.state_machine.transition(State.STARTING)
+
+        step = combo.window_step
+        start = time.perf_counter()
+        for path in wav_paths:
+            samples, rate = read_wav(path)
+            if rate != combo.SAMPLE_FREQ:
+                raise ValueError(f"{path}: sample rate {rate} Hz, expected {combo.SAMPLE_FREQ} Hz")
+            for i in range(0, len(samples) - step + 1, step):
+                indata = samples[i:i + step].reshape(-1, 1)
+                clock.now += step / combo.SAMPLE_FREQ
+                combo.callback(indata, step, None, None)
+                strip.tick()
+                blocks += 1
+                if combo.songs.FINISHED:
+                    break
+            if combo.songs.FINISHED:
+                break
+    elapsed = time.perf_counter() - start
+    combo.feedback.flush()
+    notes = list(read_feedback(feedback_path))
+    feedback_dir.cleanup()
+
+    return {
+        "engine": engine,
+        "finished": combo.songs.FINISHED,
+        "notes_reached": combo.songs.NOTE_INDEX,
+        "feedback": combo.filter_feedback(notes),
+        "notes": notes,
+        "timeline": timeline.events,
+        "events": combo.state_machine.log.dump(),
+        "blocks": blocks,
+        "stream_seconds": round(clock.now, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "frames_per_second": round(blocks / elapsed, 1) if elapsed > 0 else None,
+        "realtime_factor": round(clock.now / elapsed, 1) if elapsed > 0 else None,
+        "leds": leds.report(strip.updates),
+        "stages": METRICS.snapshot()["stages"],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay wav recordings through the detection and state machine pipeline")
+    parser.add_argument("wav", nargs="+", help="16 bit PCM recordings at the stream sample rate")
+    parser.add_argument("--song", default=combo.file_path_no_app, help="song json")
+    parser.add_argument("--engine", choices=["hps", "yin"], default=combo.PITCH_ENGINE)
+    parser.add_argument("--out", help="also write the result to this file")
+    args = parser.parse_args()
+
+    with open(args.song, 'r') as file:
+        song_data = json.load(file)
+
+    result = replay(args.wav, song_data, args.engine)
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(result, file, indent=2)
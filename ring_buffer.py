@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed size sample buffer for a sliding analysis window.
+
+    Samples are stored twice, in two back to back copies of the buffer
+    (mirrored layout), so the newest `capacity` samples are always one
+    contiguous slice. Writing a hop costs O(hop) and view() never copies.
+    """
+    def __init__(self, capacity, dtype=np.float64):
+        self.capacity = capacity
+        self.data = np.zeros(2 * capacity, dtype=dtype)
+        self.pos = 0  # index of the oldest sample, where the next write goes
+
+    def extend(self, samples):
+        n = len(samples)
+        if n >= self.capacity:
+            # only the newest samples survive
+            samples = samples[n - self.capacity:]
+            n = self.capacity
+        first = min(n, self.capacity - self.pos)
+        end = self.pos + first
+        self.data[self.pos:end] = samples[:first]
+        self.data[self.pos + self.capacity:end + self.capacity] = samples[:first]
+        if first < n:
+            rest = n - first
+            self.data[:rest] = samples[first:]
+            self.data[self.capacity:self.capacity + rest] = samples[first:]
+        self.pos = (self.pos + n) % self.capacity
+
+    def view(self):
+        """Returns the window, oldest sample first, as a read only view."""
+        window = self.data[self.pos:self.pos + self.capacity]
+        window.flags.writeable = False
+        return window
+
+    def oldest(self, n):
+        """Returns a view of the oldest n samples, the ones the next n written samples replace."""
+        return self.data[self.pos:self.pos + n]
+
+
+class NoteHistory:
+    """The last few detected notes, newest first."""
+    def __init__(self, length=2):
+        # placeholders that never match, so a note must be seen `length` times
+        self.notes = [str(i + 1) for i in range(length)]
+
+    def push(self, note):
+        self.notes.insert(0, note)
+        self.notes.pop()
+
+    def stable(self):
+        """True if every note in the history is the same."""
+        return self.notes.count(self.notes[0]) == len(self.notes)
@@ -0,0 +1,95 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_SESSION = "default" # clients that don't send a session id share this one
+SESSION_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+
+class Session:
+    """
+    State of one client (a phone and its board): the feedback waiting for
+    it. Waiters on /send_json sleep on `cond`.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.feedback = None
+        self.waiters = 0 # threads in take_feedback, the session isn't evicted while there are any
+        self.seen = time.monotonic()
+
+    def put_feedback(self, feedback):
+        with self.cond:
+            self.feedback = feedback
+            self.cond.notify_all()
+
+    def take_feedback(self, timeout=None):
+        """
+        Waits up to timeout seconds for feedback, the first waiter takes it
+        Returns:
+          feedback (list): None if there was none
+        """
+        with self.cond:
+            self.waiters += 1
+            try:
+                self.cond.wait_for(lambda: self.feedback is not None, timeout=timeout)
+            finally:
+                self.waiters -= 1
+            feedback, self.feedback = self.feedback, None
+            return feedback
+
+
+class SessionStore:
+    """
+    Sessions by id, for the server's request threads. A session is dropped
+    once it hasn't been used for `ttl` seconds, and the least recently used
+    ones go first when there are more than `max_sessions`, so memory stays
+    bounded however many clients come and go. Sessions with waiters and the
+    one just asked for are kept, the store only goes over `max_sessions`
+    while there is nothing else to drop.
+    """
+    def __init__(self, ttl=600, max_sessions=256):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict() # least recently used first
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def get(self, key=DEFAULT_SESSION):
+        """
+        Returns:
+          session (Session): the session with this id, a new one if there is none
+        Raises:
+          ValueError: if key isn't a valid session id
+        """
+        if not SESSION_PATTERN.fullmatch(key):
+            raise ValueError(f"Invalid session id {key!r}")
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = Session(key)
+            else:
+                self.sessions.move_to_end(key)
+            session.seen = now
+            self.evict(now, keep=key)
+            return session
+
+    def evict(self, now, keep=None):
+        # a session with waiters stays, the ones used after it may still go. so does
+        # `keep`, the one being handed out, even if that leaves too many for now
+        excess = len(self.sessions) - self.max_sessions
+        evict = []
+        for session in self.sessions.values():
+            if excess <= 0 and now - session.seen <= self.ttl:
+                break
+            if not session.waiters and session.key != keep:
+                evict.append(session.key)
+                excess -= 1
+        for key in evict:
+            del self.sessions[key]
+        self.evicted += len(evict)
+
+    def __len__(self):
+        return len(self.sessions)
@@ -1,2 +1,2 @@
 #!/bin/bash
-python3 -c "from led_control import Strip; Strip().colourWipe()"
+python3 -c "from led_control import Strip; strip = Strip(); strip.colourWipe(); strip.close()"
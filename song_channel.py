@@ -0,0 +1,96 @@
+import json
+import os
+import socket
+import threading
+
+SONG_SOCKET = "/tmp/fydp_song.sock" # the player listens here for songs from wifi-server.py
+
+
+class SongChannel:
+    """
+    Player end of the song handoff: a Unix socket wifi-server.py connects to
+    with each song the app sends. A song is one line of json and the reply
+    is one line of json with the status, so the server can tell the app
+    straight away whether the player took it. A thread accepts songs at any
+    time, also while a song is playing. Only the newest one waits for get(),
+    a song sent while another was waiting replaces it, as song.json did.
+    """
+    def __init__(self, path=SONG_SOCKET, check=None):
+        self.path = path
+        self.check = check  # returns the song to queue, raises ValueError for a song that can't be played
+        self.song = None  # the song waiting for get()
+        self.cond = threading.Condition()
+        if os.path.exists(path):
+            os.unlink(path)  # left over from a player that didn't shut down cleanly
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o666)  # the server may run as another user
+        self.sock.listen(8)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break  # closed
+            with conn:
+                conn.settimeout(5)
+                try:
+                    song_data = json.loads(read_line(conn))
+                    if self.check:
+                        song_data = self.check(song_data)
+                    self.put(song_data)
+                    reply = {"status": "success"}
+                except (ValueError, AttributeError, TypeError, OSError) as e:
+                    reply = {"status": "error", "message": str(e)}
+                try:
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+                except OSError:
+                    pass  # the server stopped waiting for the reply
+
+    def put(self, song_data):
+        with self.cond:
+            self.song = song_data
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """Returns the newest song, or None if none arrived within timeout seconds."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.song is not None, timeout=timeout)
+            song_data, self.song = self.song, None
+            return song_data
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def read_line(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+    return b"".join(chunks).decode()
+
+
+def send_song(song_data, path=SONG_SOCKET, timeout=2):
+    """
+    Hands a song to the player
+    Returns:
+      reply (dict): the player's status, None if no player is listening
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(song_data).encode() + b"\n")
+            return json.loads(read_line(sock))
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+from songs import PLAN_DTYPE
+
+LIBRARY_DIR = "song_library" # compiled songs the player has been sent, one file each
+
+# file layout: header, title in utf-8, then the plan rows as stored in memory
+MAGIC = b"FSNG"
+VERSION = 2 # 2 dropped the plan's FFT bin ranges, older files are compiled again
+HEADER = struct.Struct("<4sHHd") # magic, version, title length, concert pitch
+ID_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+
+def song_id(song_data):
+    """
+    Content hash of a song, the same for the same title and notes however the
+    json was formatted: the first 16 hex digits of the sha256 of
+    json.dumps({"title": ..., "notes": ...}, sort_keys=True, separators=(",", ":"))
+    """
+    canonical = json.dumps({"title": song_data.get("title"), "notes": song_data.get("notes")},
+                           sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+class SongLibrary:
+    """
+    Compiled songs on disk, keyed by song_id(). The player adds every song it
+    is sent, so a repeat lesson is started by id without uploading or
+    compiling the song again. wifi-server.py reads the same directory to
+    list the songs and answer whether one is cached.
+    """
+    def __init__(self, root=LIBRARY_DIR):
+        self.root = root
+
+    def path(self, song_id):
+        if not isinstance(song_id, str) or not ID_PATTERN.fullmatch(song_id):
+            raise KeyError(song_id)
+        return os.path.join(self.root, song_id + ".song")
+
+    def __contains__(self, song_id):
+        try:
+            return os.path.exists(self.path(song_id))
+        except KeyError:
+            return False
+
+    def save(self, song_id, title, plan, concert_pitch):
+        """
+        Parameters:
+          song_id (str): song_id() of the song the plan was compiled from
+          title (str): title of the song
+          plan (np.ndarray): PLAN_DTYPE rows from compile_song
+          concert_pitch (float): what the plan was compiled for
+        """
+        path = self.path(song_id)
+        os.makedirs(self.root, exist_ok=True)
+        title = (title or "").encode()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(title), concert_pitch))
+            file.write(title)
+            file.write(np.ascontiguousarray(plan, dtype=PLAN_DTYPE).tobytes())
+        os.replace(tmp_path, path)  # the server may be listing the directory
+
+    def remove(self, song_id):
+        """Deletes a song's file, e.g. one load() found damaged, so it is compiled again."""
+        try:
+            os.remove(self.path(song_id))
+        except FileNotFoundError:
+            pass
+
+    def read_header(self, file):
+        magic, version, title_len, concert_pitch = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{file.name} is not a compiled song")
+        title = file.read(title_len)
+        if len(title) < title_len:
+            raise ValueError(f"{file.name} is truncated")
+        return title.decode(), concert_pitch
+
+    def load(self, song_id):
+        """
+        Returns:
+          song (dict): id, title, plan and concert_pitch
+        Raises:
+          KeyError: if the song is not in the library
+          ValueError: if its file is damaged
+        """
+        try:
+            file = open(self.path(song_id), 'rb')
+        except FileNotFoundError:
+            raise KeyError(song_id)
+        with file:
+            try:
+                title, concert_pitch = self.read_header(file)
+            except struct.error:
+                raise ValueError(f"{file.name} is truncated")
+            data = file.read()
+        if len(data) % PLAN_DTYPE.itemsize:
+            raise ValueError(f"{file.name} is truncated")
+        plan = np.frombuffer(data, dtype=PLAN_DTYPE).copy()
+        return {"id": song_id, "title": title, "plan": plan,
+                "concert_pitch": concert_pitch}
+
+    def info(self, song_id):
+        """
+        Returns:
+          info (dict): id, title, number of notes, seconds of music and when it was added
+        Raises:
+          KeyError: if the song is not in the library
+        """
+        song = self.load(song_id)
+        return {"id": song_id, "title": song["title"], "notes": len(song["plan"]),
+                "duration": round(float(song["plan"]["duration"].sum()), 3),
+                "added": os.path.getmtime(self.path(song_id))}
+
+    def list(self):
+        """Returns info() of every song, newest first."""
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        songs = []
+        for name in names:
+            song_id, ext = os.path.splitext(name)
+            if ext != ".song":
+                continue
+            try:
+                songs.append(self.info(song_id))
+            except (KeyError, ValueError):
+                pass  # removed meanwhile, or not one of ours
+        songs.sort(key=lambda song: song["added"], reverse=True)
+        return songs
@@ -1,8 +1,75 @@
 import time
 import json
+import logging
+
+import numpy as np
+
+from pitch import note_frequency, note_name, note_number
+
+log = logging.getLogger("player.songs")
+
+NOTE_TYPES = ["q", "h", "w"] # LED colour class of a note, see Strip.turnOnLED
+QUARTER_SECONDS = 0.24 # a quarter note in the app's songs
+# longest note of each colour class but the last, in quarters. the app's
+# durations are a quarter or a dotted one (0.24, 0.36 s), a half or a dotted
+# one (0.48, 0.72 s), or longer, so the limits lie between those
+NOTE_TYPE_LIMITS = [1.75, 3.5]
+
+# one row per note of a compiled song
+PLAN_DTYPE = np.dtype([
+    ("led", "i2"),
+    ("note_type", "i1"),  # index into NOTE_TYPES
+    ("midi", "i2"),
+    ("freq", "f8"),       # expected fundamental in hertz
+    ("duration", "f8"),
+    ("min_hold", "f8"),   # seconds the note has to be held to move on
+])
+
+
+def compile_song(notes, note_conversion, concert_pitch=440):
+    """
+    Checks a song's notes and turns them into a plan, so that moving to the
+    next note needs no lookups
+    Parameters:
+      notes (list): {"note": "E4", "duration": 0.36} dicts as sent by the app
+      note_conversion (dict): note name -> LED
+      concert_pitch (float): pitch of a4 in hertz
+    Returns:
+      plan (np.ndarray): PLAN_DTYPE rows
+    Raises:
+      ValueError: if a note is malformed, has no LED or no positive duration
+    """
+    if not isinstance(notes, list) or not notes:
+        raise ValueError("song has no notes")
+    plan = np.zeros(len(notes), dtype=PLAN_DTYPE)
+    for i, note in enumerate(notes):
+        name = note.get("note") if isinstance(note, dict) else None
+        duration = note.get("duration") if isinstance(note, dict) else None
+        try:
+            midi = note_number(name)
+        except (ValueError, TypeError, IndexError):
+            raise ValueError(f"note {i}: invalid note name {name!r}")
+        if midi < 0:
+            raise ValueError(f"note {i}: missing note name")
+        if name not in note_conversion:
+            raise ValueError(f"note {i}: {name} has no LED")
+        if not isinstance(duration, (int, float)) or duration <= 0:
+            raise ValueError(f"note {i}: invalid duration {duration!r}")
+        plan[i] = (note_conversion[name], 0, midi, note_frequency(name, concert_pitch), duration, duration)
+
+    # the same length has the same colour in every song
+    plan["note_type"] = np.searchsorted(NOTE_TYPE_LIMITS, plan["duration"] / QUARTER_SECONDS, side="right")
+    return plan
+
+
+def plan_notes(plan):
+    """The notes a plan was compiled from, as the app sends them."""
+    return [{"note": note_name(int(midi)), "duration": float(duration)}
+            for midi, duration in zip(plan["midi"], plan["duration"])]
+
 
 class Songs:
-    def __init__(self, MATCH_DELAY, strip, note_conversion):
+    def __init__(self, MATCH_DELAY, strip, note_conversion, concert_pitch=440):
 
         #self.file_path = file_path
         self.notes = None
@@ -13,6 +80,9 @@ class Songs:
         # self.NoteConversion = {'C3':7, 'B3':1, 'A3':2, 'G3': 3, 'F3':4, 'E3': 5, 'D3':6}
         # self.NoteConversion = {'A6':1, 'G5':2, 'F5':3, 'E5': 4, 'D5':5, 'C5': 6, 'B5':7, 'A5':8,'G4':9, 'F4':10, 'E4':11, 'D4':12, 'C4':13, 'B4': 14, 'A4':15, 'G3':16, 'F3':17, 'E3':18, 'D3':19, 'C3':20, 'B3': 21, 'A3': 22}
         self.NoteConversion = note_conversion
+        self.concert_pitch = concert_pitch
+        self.plan = None # compile_song() of the current song
+        self.session = None # server session the song came from, its feedback goes back there
         self.Start = True
         self.CurrentNote = None
         self.WrongNoteName = None
@@ -21,20 +91,19 @@ class Songs:
         self.SILENT = True
 
     def start(self):
-        note = self.setCurrentNote()
-        # print(note)
-        led = self.NoteConversion.get(note.get("note"))
-        # print(led)
-
-        self.strip.startSeq(led)
-
-    def setSong(self, song_data): #song_data: json
-        print("song", song_data.get('title'))
-        print("song", song_data.get('notes'))
+        self.setCurrentNote()
+        self.strip.startSeq(int(self.plan["led"][self.NOTE_INDEX]))
 
-        print( song_data["notes"])
-        print(f"Setting song: {song_data.get('title')}")
-        self.notes = song_data["notes"]  # Directly use the "notes" array
+    def setSong(self, song_data): #song_data: json, or a song from the library with its "plan"
+        log.info("Setting song: %s", song_data.get('title'))
+        log.debug("Notes: %s", song_data.get('notes'))
+        plan = song_data.get("plan")
+        if plan is None:
+            # raises before anything changes if the song can't be played
+            plan = compile_song(song_data.get("notes"), self.NoteConversion, self.concert_pitch)
+        self.plan = plan
+        self.notes = song_data.get("notes") or plan_notes(plan)
+        self.session = song_data.get("session")
         self.NOTE_INDEX = 0  # Reset the note index
         self.FINISHED = False  # Reset the finished flag
         self.setCurrentNote()  # Set the first note
@@ -46,9 +115,25 @@ class Songs:
             return note_info
         
         self.FINISHED = True
-        print("Lesson complete!")
+        log.info("Lesson complete!")
         return "FINI" 
     
+    def noteRange(self):
+        # lowest and highest note with an LED, LED 1 is the highest note
+        lowest = max(self.NoteConversion, key=self.NoteConversion.get)
+        highest = min(self.NoteConversion, key=self.NoteConversion.get)
+        return lowest, highest
+
+    def expectedFrequencies(self):
+        # frequencies of the note being waited for and the one after it
+        if self.plan is None or self.FINISHED:
+            return []
+        return self.plan["freq"][self.NOTE_INDEX:self.NOTE_INDEX + 2].tolist()
+
+    def minHold(self):
+        # seconds the current note has to be held
+        return self.plan["min_hold"][self.NOTE_INDEX]
+
     def setWrongNote(self, played_note):
         #turn off previous note if self.WrongNoteName != None & played_note != self.WrongNoteName 
         if self.WrongNoteName != None and played_note != self.WrongNoteName:
@@ -65,28 +150,13 @@ class Songs:
     def nextNote(self):
         # moves to the next note and updates the LED indicator
         self.NOTE_INDEX += 1
-        if (self.NOTE_INDEX < len(self.notes)):
-            note = self.setCurrentNote()
-            note_name = note["note"]
-            # print(note_name)
-            led = self.NoteConversion.get(note_name)
-            # print(led)
-            if led:
-                if note.get("duration") == 0.24:
-                    # print("q")
-                    self.strip.turnOnLED(led, "q")
-                elif note.get("duration") == 0.48:
-                    # print("h")
-                    self.strip.turnOnLED(led, "h")
-                elif note.get("duration") == 0.96:
-                    # print("w")
-                    self.strip.turnOnLED(led, "w")
-                else:
-                    # print("q")
-                    self.strip.turnOnLED(led, "q")
+        if (self.NOTE_INDEX < len(self.plan)):
+            self.CurrentNote = self.notes[self.NOTE_INDEX]
+            step = self.plan[self.NOTE_INDEX]
+            self.strip.turnOnLED(int(step["led"]), NOTE_TYPES[step["note_type"]])
         else:
             self.FINISHED = True
-            print("Lesson complete!")
+            log.info("Lesson complete!")
             return "FINI" 
    
 
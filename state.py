@@ -1,137 +1,285 @@
 import time
 import json
+from enum import IntEnum
+
+import numpy as np
+
+
+class State(IntEnum):
+    STARTING = 0
+    SILENT_START = 1
+    WAITING = 2
+    LISTENING = 3
+    LISTENING_WRONG_NOTE = 4
+    IDLE = 5
+
+
+class Event(IntEnum):
+    ONSET = 0       # the onset detector heard an attack
+    SILENCE = 1
+    MATCH = 2       # the note the song is waiting for
+    WRONG_HELD = 3  # the wrong note that is already lit
+    WRONG = 4       # any other note
+
+
+# state -> {event: handler}, events missing from a row are ignored.
+# A row's None entry handles every event not listed.
+TRANSITIONS = {
+    State.STARTING: {None: "starting"},
+    State.SILENT_START: {None: "silent_start"},
+    State.WAITING: {
+        Event.MATCH: "waiting_match",
+        Event.WRONG_HELD: "waiting_wrong",
+        Event.WRONG: "waiting_wrong",
+    },
+    State.LISTENING: {
+        Event.ONSET: "listening_onset",
+        Event.MATCH: "listening_match",
+        Event.SILENCE: "listening_silence",
+        Event.WRONG_HELD: "listening_wrong",
+        Event.WRONG: "listening_wrong",
+    },
+    State.LISTENING_WRONG_NOTE: {
+        Event.ONSET: "wrong_note_onset",
+        Event.WRONG_HELD: "wrong_note_held",
+        Event.MATCH: "wrong_note_match",
+        Event.SILENCE: "wrong_note_silence",
+        Event.WRONG: "wrong_note_new",
+    },
+    State.IDLE: {
+        Event.SILENCE: "idle_silence",
+        Event.MATCH: "idle_note",
+        Event.WRONG_HELD: "idle_note",
+        Event.WRONG: "idle_note",
+    },
+}
+
+
+class EventLog:
+    """
+    Fixed size log of the inputs the state machine handled, for debugging
+    and replaying a session. Entries live in one preallocated record array
+    used as a ring, so adding one never allocates and the oldest entries
+    are overwritten once it is full.
+    """
+    DTYPE = np.dtype([("time", "f8"), ("state", "i1"), ("event", "i1"),
+                      ("note", "i2"), ("position", "i4")])
+
+    def __init__(self, size=4096):
+        self.entries = np.zeros(size, dtype=self.DTYPE)
+        self.size = size
+        self.count = 0  # entries added since the start
+        self.note_names = []  # played note of an entry is an index into this, -1 for none
+        self.note_ids = {}
+
+    def add(self, timestamp, state, event, note, position):
+        note_id = -1
+        if event >= Event.MATCH:
+            note_id = self.note_ids.get(note)
+            if note_id is None:
+                note_id = self.note_ids[note] = len(self.note_names)
+                self.note_names.append(note)
+        self.entries[self.count % self.size] = (timestamp, state, event, note_id, position)
+        self.count += 1
+
+    def records(self):
+        """The entries in the log, oldest first, as a record array."""
+        if self.count <= self.size:
+            return self.entries[:self.count]
+        start = self.count % self.size
+        return np.concatenate((self.entries[start:], self.entries[:start]))
+
+    def dump(self):
+        """
+        Returns:
+          events (list): dicts with time, state and event names, played note
+                         and position in the song, oldest first
+        """
+        return [{"time": round(float(entry["time"]), 3),
+                 "state": State(entry["state"]).name.lower(),
+                 "event": Event(entry["event"]).name.lower(),
+                 "note": self.note_names[entry["note"]] if entry["note"] >= 0 else None,
+                 "position": int(entry["position"])}
+                for entry in self.records()]
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.dump(), file)
 
 
 class NoteStateMachine:
-    def __init__(self, song, feedback):
+    """
+    Follows the player through the song. handle_input() classifies each input
+    into an Event and calls the handler TRANSITIONS gives for the current
+    State, one table lookup per input. Every input is kept in self.log.
+    Each recorded note and each move to the next note is also sent to
+    `progress` (a progress.ProgressSender) as it happens, if given.
+    """
+    def __init__(self, song, feedback, clock=time.perf_counter, log_size=4096, progress=None):
         self.song = song
-        self.state = "starting"  # Initial state
+        self.progress = progress
+        self.clock = clock  # returns the current time in seconds, replays pass in the stream time
+        self.state = State.STARTING  # Initial state
         self.current_duration = 0  # Tracks how long a note has been sustained
         self.start_time = None
         self.last_match_time = None
         self.feedback = feedback
         self.duaration_met = False
         self.minimum_silence = 3
+        self.onset_time = None  # time of the last attack heard by the onset detector
+        self.input_time = None  # time of the input being handled
+        self.max_onset_age = 1.5  # an attack older than this (s) no longer starts the next note
+        self.log = EventLog(log_size)
+
+        # compile TRANSITIONS into a state x event table of bound methods
+        self.table = []
+        for state in State:
+            row = TRANSITIONS[state]
+            default = getattr(self, row[None]) if None in row else self.ignore
+            handlers = [getattr(self, row[event]) if event in row else default for event in Event]
+            handlers[Event.ONSET] = getattr(self, row[Event.ONSET]) if Event.ONSET in row else self.onset
+            self.table.append(handlers)
 
+    def classify(self, played_note):
+        if played_note == "ONSET":
+            return Event.ONSET
+        if played_note == "SILENCE":
+            return Event.SILENCE
+        current = self.song.CurrentNote
+        if current is not None and played_note == current.get("note"):
+            return Event.MATCH
+        if played_note == self.song.WrongNoteName:
+            return Event.WRONG_HELD
+        return Event.WRONG
+
+    def handle_input(self, played_note, when=None):
+        """
+        Parameters:
+          played_note (str): a note name, "SILENCE" or "ONSET"
+          when (float): clock time it happened, now if None. The listener
+                        passes the time of the attack with an ONSET
+        """
+        event = self.classify(played_note)
+        self.input_time = self.clock() if when is None else when
+        self.log.add(self.input_time, self.state, event, played_note, self.song.NOTE_INDEX)
+        if self.song.FINISHED:
+            return  # past the last note, nothing to match until the next song
+        self.table[self.state][event](played_note)
 
     def transition(self, new_state):
-        print(f"Transitioning from {self.state} to {new_state}")
-        self.state = new_state
+        self.state = State(new_state)
+
+    def note_start(self):
+        # time a note from its attack if the onset detector heard one recently
+        now = self.clock()
+        start = now
+        if self.onset_time is not None and now - self.onset_time < self.max_onset_age:
+            start = self.onset_time
+        self.onset_time = None
+        return start
+
+    def ignore(self, played_note):
+        pass
+
+    def onset(self, played_note):
+        self.onset_time = self.input_time
 
-        
     def starting(self, played_note):
-        self.start_time = time.perf_counter()
-#   # Start timing the note
-#         if played_note == "SILENCE":
-#             print(" WAITING FOR  OF SILENCE...")
-        self.transition("silent_start")
-    
+        self.start_time = self.clock()
+        self.transition(State.SILENT_START)
+
     def silent_start(self, played_note):
-        silence_duration = time.perf_counter() - self.start_time
+        silence_duration = self.clock() - self.start_time
         if silence_duration > self.minimum_silence:
-            print(" Good to start", silence_duration)
             self.song.start()
-            self.transition("waiting")
-     
-
-
-    def waiting(self, played_note):
-        current_note_name = self.song.CurrentNote.get("note")
-        print(f"Waiting for: {current_note_name}, Received: {played_note}")
-
-        if played_note == current_note_name:
-            self.start_time = time.perf_counter()
-  # Start timing the note
-            self.transition("listening")
-
-        elif played_note == "SILENCE":
-            pass
-            print("Still waiting...")
-        else:
-            print("Wrong note!")
-            self.start_time = time.perf_counter()
-  # Start timing the note
-            self.transition("listening_wrong_note")
-
-    def listening(self, played_note):
-        print ("LISTEN LISTEN")
-        current_note_name = self.song.CurrentNote.get("note")
-        intended_duration = self.song.CurrentNote.get("duration")
-
-        if played_note == current_note_name:
-            self.current_duration = time.perf_counter() - self.start_time
-            print(f"Listening: {played_note} for {self.current_duration:.2f}s out of {intended_duration:.2f}s")
-
-        elif played_note == "SILENCE": #not relased
-            #check if long enoguh
-            if self.current_duration <= intended_duration: #played too short
-                print("Silence detected! and note not held for right time")
-                self.record_feedback(current_note_name)
-                self.transition("waiting")
-            # elif self.current_duration <= 3 * intended_duration: #played long enogu change times
-            else:
-                print("Silence detected! and note held for right time")
-                self.record_feedback(current_note_name)
-                self.song.nextNote() #set to next note
-                self.start_time = time.perf_counter()
-                self.transition("waiting") 
-
-        else:
-            print("Wrong note detected!")
-            self.song.setWrongNote(played_note)
-            self.record_feedback(current_note_name)
-            self.start_time = time.perf_counter()
-  # Start timing the note
-            self.transition("listening_wrong_note")
-
-    def listening_wrong_note(self, played_note): #FIX THIS
-        current_note_name = self.song.CurrentNote.get("note")
-        current_wrong_note_name = self.song.WrongNoteName
-        print(f"Waiting for: {current_note_name}, Currently Playing: {played_note}")
-        self.current_duration = time.perf_counter() - self.start_time
-
-        if played_note == current_wrong_note_name:
-            print("Wrong note being held")
-            self.current_duration = time.perf_counter() - self.start_time
-        elif played_note == current_note_name:
-            self.song.setWrongNote(None)
-            self.record_feedback(current_wrong_note_name)
-            self.start_time = time.perf_counter()
-  # Start timing the note
-            self.transition("listening")
-        elif played_note == "SILENCE":
-            self.song.setWrongNote(None)
-            self.record_feedback(current_wrong_note_name)
-            print("Silence detected!")
-            self.transition("waiting")
-        else: #new wrong note
-            self.record_feedback(current_wrong_note_name)
-            self.start_time = time.perf_counter()
-  # Start timing the note
-            self.song.setWrongNote(played_note)
-        
+            self.send_next()
+            self.transition(State.WAITING)
+
+    def waiting_match(self, played_note):
+        self.start_time = self.note_start()  # Start timing the note
+        self.current_duration = 0
+        self.transition(State.LISTENING)
+
+    def waiting_wrong(self, played_note):
+        self.start_time = self.note_start()
+        self.transition(State.LISTENING_WRONG_NOTE)
+
+    def listening_match(self, played_note):
+        self.current_duration = self.clock() - self.start_time
+
+    def listening_silence(self, played_note):
+        # released, move on if it was held long enough
+        self.record_feedback(self.song.CurrentNote.get("note"))
+        if self.current_duration > self.song.minHold():
+            self.next_note()
+            self.start_time = self.clock()
+        self.transition(State.WAITING)
+
+    def listening_onset(self, played_note):
+        # a new attack: the held note has been released, even without a gap
+        self.listening_silence(played_note)
+        self.onset(played_note)
+
+    def listening_wrong(self, played_note):
+        self.song.setWrongNote(played_note)
+        self.record_feedback(self.song.CurrentNote.get("note"))
+        self.start_time = self.note_start()
+        self.transition(State.LISTENING_WRONG_NOTE)
+
+    def wrong_note_held(self, played_note):
+        self.current_duration = self.clock() - self.start_time
+
+    def wrong_note_match(self, played_note):
+        self.current_duration = self.clock() - self.start_time
+        self.record_feedback(self.song.WrongNoteName)
+        self.song.setWrongNote(None)
+        self.start_time = self.note_start()
+        self.current_duration = 0
+        self.transition(State.LISTENING)
+
+    def wrong_note_silence(self, played_note):
+        self.current_duration = self.clock() - self.start_time
+        self.record_feedback(self.song.WrongNoteName)
+        self.song.setWrongNote(None)
+        self.transition(State.WAITING)
+
+    def wrong_note_onset(self, played_note):
+        self.wrong_note_silence(played_note)
+        self.onset(played_note)
+
+    def wrong_note_new(self, played_note):
+        self.current_duration = self.clock() - self.start_time
+        self.record_feedback(self.song.WrongNoteName)
+        self.start_time = self.note_start()
+        self.song.setWrongNote(played_note)
+
+    def idle_silence(self, played_note):
+        self.next_note()
+        self.transition(State.WAITING)
+
+    def idle_note(self, played_note):
+        self.start_time = self.clock()
+
     def record_feedback(self, played_note):
         if played_note:
-            self.feedback.append({played_note:self.current_duration})
+            current = self.song.CurrentNote
+            self.feedback.record(self.song.NOTE_INDEX, current.get("note"), played_note,
+                                 current.get("duration"), self.current_duration, self.start_time)
+            if self.progress:
+                self.progress.send({"t": "note", "i": self.song.NOTE_INDEX, "e": current.get("note"),
+                                    "p": played_note, "h": round(self.current_duration, 3),
+                                    "d": current.get("duration")})
 
-    def idle(self, played_note):
-        if played_note == "SILENCE":
-            # self.current_duration = time.perf_counter() - self.start_time
-            # if (self.current_duration > 0.):
-                self.song.nextNote()
-                self.transition("waiting")
-        else:
-            self.start_time = time.perf_counter()
-    def handle_input(self, played_note):
-        if self.state == "starting":
-            self.starting(played_note)
-        elif self.state == "silent_start":
-            self.silent_start(played_note)
-        elif self.state == "waiting":
-            self.waiting(played_note)
-        elif self.state == "listening":
-            self.listening(played_note)
-        elif self.state == "idle":
-            self.idle(played_note)
-        elif self.state == "listening_wrong_note":
-            self.listening_wrong_note(played_note)
\ No newline at end of file
+    def next_note(self):
+        self.song.nextNote()
+        self.send_next()
+
+    def send_next(self):
+        # the note now expected, or the end of the song
+        if self.progress:
+            if self.song.FINISHED:
+                self.progress.send({"t": "end", "i": self.song.NOTE_INDEX})
+            else:
+                current = self.song.CurrentNote
+                self.progress.send({"t": "next", "i": self.song.NOTE_INDEX, "n": current.get("note"),
+                                    "d": current.get("duration")})
@@ -1,28 +1,41 @@
+import argparse
+import gzip
 import signal
+import threading
 import time 
 import os
 import subprocess
 import json 
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
+from metrics import prometheus_text
+from song_channel import send_song
+from song_library import SongLibrary, song_id
+from progress import ProgressStream
+from logs import setup_logging
+from sessions import SessionStore, DEFAULT_SESSION
 import sys
 app = Flask(__name__)
 
-# Configure logging
-logging.basicConfig(
-    filename="output.log",  # Save logs to a file
-    level=logging.DEBUG,  # Set log level
-    format="%(asctime)s - %(levelname)s - %(message)s",  # Log format
-)
+LOG_FILE = "output.log" # rotated, see logs.py and main
+log = logging.getLogger("server")
 
-feedback_data = None #store the feedback data globally 
-song_data = None #the song data that will get passed to combo.py to start lighting up LEDs 
+# each client's song and feedback, by the session id it sends in the
+# X-Session-ID header or ?session=, see sessions.py
+sessions = SessionStore(ttl=600, max_sessions=256)
+LONG_POLL_TIMEOUT = 20 # seconds /send_json waits for feedback
+song_file_lock = threading.Lock() # request threads take turns writing song.json
 FEEDBACK_FILE_PATH = 'feedback.json'
+SONG_FILE_PATH = 'song.json' # read by combo.py when it starts
+METRICS_FILE_PATH = 'metrics.json' # written by combo.py every few seconds
+library = SongLibrary() # filled by combo.py, see song_library.py
+progress = None # ProgressStream of the player's note events, opened by main
+SSE_KEEPALIVE = 15 # seconds between comments on an idle /progress stream
 
 def setup_hotspot():
     #Configures Raspberry Pi as a Wi-Fi hotspot
     try:
-        print("Setting up the Raspberry Pi as a hotspot...")
+        log.info("Setting up the Raspberry Pi as a hotspot...")
 
         # Restart the hotspot services
         subprocess.run(["sudo", "systemctl", "restart", "hostapd", "dnsmasq"], check=True)
@@ -30,20 +43,43 @@ def setup_hotspot():
         # Assign a static IP to wlan0
         subprocess.run(["sudo", "ip", "addr", "add", "192.168.4.1/24", "dev", "wlan0"], check=True)
 
-        print("Hotspot setup complete.")
+        log.info("Hotspot setup complete.")
     except subprocess.CalledProcessError as e:
-        print(f"Error setting up hotspot: {e}")
+        log.error("Error setting up hotspot: %s", e)
 
 def disable_hotspot():
-    print("Shutting down hotspot...")
+    log.info("Shutting down hotspot...")
     subprocess.run(["sudo", "systemctl", "stop", "hostapd", "dnsmasq"], check=True)
     subprocess.run(["sudo", "ip", "addr", "flush", "dev", "wlan0"], check=True)
-    print("Hotspot has been disabled.")
+    log.info("Hotspot has been disabled.")
+
+def request_session():
+    # raises ValueError for an invalid id
+    return sessions.get(request.headers.get("X-Session-ID") or request.args.get("session") or DEFAULT_SESSION)
+
+def start_song(song):
+    """
+    Hands a song to the player, or leaves it in song.json if the player isn't running yet
+    Returns:
+      delivered (bool): whether the player has it, it reads song.json when it starts otherwise
+      error: the response to return if the player rejected the song, else None
+    """
+    # straight to the player, song.json is only for a player that isn't running yet
+    reply = send_song(song)
+    if reply is None:
+        with song_file_lock:
+            tmp_path = SONG_FILE_PATH + ".tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(song, file)
+            os.replace(tmp_path, SONG_FILE_PATH) # the player never reads half a song
+    elif reply.get("status") != "success":
+        return True, (jsonify({"status": "error", "message": reply.get("message", "Song rejected")}), 400)
+    return reply is not None, None
 
 @app.route('/receive_json', methods=['POST'])
 def receive_json():
-        global song_data #storing received song data in JSON 
         try:
+                session = request_session()
                 data = request.get_json()
                 # Extracting song data
                 song_data = {
@@ -51,31 +87,67 @@ def receive_json():
                 "notes": data.get("notes", [])  # Ensure it's passed as a list
                 }
 
-                # Debugging output
-                print("Received JSON:", song_data)
-                with open('song.json', 'w') as file:
-                    json.dump(song_data, file, indent=4)  # 'indent' makes the JSON more readable
-                return jsonify({"status": "success", "message": "Data received",  "song_data": song_data }), 200
+                key = song_id(song_data)
+                log.info("Received song %s: %s, %d notes", key, song_data["title"], len(song_data["notes"]))
+                log.debug("Received JSON: %s", song_data)
+                # the player takes a song it has compiled before from its library by the id,
+                # the notes are there in case its copy is gone or damaged. the player
+                # sends the feedback back with the session, see /send_feedback
+                song = dict(song_data, id=key, session=session.key)
+                delivered, error = start_song(song)
+                if error:
+                    return error
+                response = jsonify({"status": "success", "message": "Data received", "delivered": delivered, "id": key, "song_data": song_data })
+                response.set_etag(key)
+                return response, 200
         except Exception as e: 
                 return jsonify({"status": "error", "message": str(e)}), 400
 
 
+# SONGS THE PLAYER HAS COMPILED. the app checks a song's id (or ETag) here and
+# starts it with /songs/<id>/start instead of uploading it again
+@app.route('/songs', methods=['GET'])
+def list_songs():
+    return jsonify({"songs": library.list()}), 200
+
+@app.route('/songs/<key>', methods=['GET', 'HEAD'])
+def song_info(key):
+    try:
+        info = library.info(key)
+    except (KeyError, ValueError):
+        return jsonify({"status": "error", "message": "Song not in library"}), 404
+    response = jsonify(info)
+    response.set_etag(key)
+    return response.make_conditional(request) # 304 if the app sent If-None-Match with the id
+
+@app.route('/songs/<key>/start', methods=['POST'])
+def start_cached_song(key):
+    try:
+        session = request_session()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        library.info(key) # a damaged file is as good as none, the player would reject it
+    except (KeyError, ValueError):
+        return jsonify({"status": "error", "message": "Song not in library, upload it to /receive_json"}), 404
+    delivered, error = start_song({"id": key, "session": session.key})
+    if error:
+        return error
+    return jsonify({"status": "success", "message": "Song started", "delivered": delivered, "id": key}), 200
+
+
 # SENDING JSON TO IPHONE (IPHONE DOES GET)
 @app.route('/send_json', methods=['GET'])
 def send_data():
-    global feedback_data 
-    timeout = 20 #maximum wait time 
-    interval = 1 #how often to check 
-    elapsed_time = 0
-
-    while feedback_data is None and elapsed_time < timeout:
-        time.sleep(interval)
-        elapsed_time += interval 
-
-    if feedback_data: 
-        response = jsonify(feedback_data)
-        feedback_data = None 
-        return response, 200 
+    try:
+        session = request_session()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    # sleeps until /send_feedback stores something for this session, the first waiter takes it
+    data = session.take_feedback(LONG_POLL_TIMEOUT)
+
+    if data: 
+        return jsonify(data), 200 
     else: 
         return jsonify({"status": "pending"}), 204  # no feedback yet
     
@@ -83,26 +155,89 @@ def send_data():
 # RECEIVING FEEDBACK DATA FROM RASPBERRY PI. pi will do post to here w feedback data
 @app.route('/send_feedback', methods=['POST'])
 def receive_feedback():
-    global feedback_data
     try:
-        data = request.get_json()
+        body = request.get_data()
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        data = json.loads(body)
+
+        # the player's uploader sends {"batch": [spool records]}, each with the session
+        # the song came from. a session's app only needs its newest feedback
+        if isinstance(data, dict) and isinstance(data.get("batch"), list) and data["batch"]:
+            latest = {}
+            for record in data["batch"]:
+                latest[record.get("session") or DEFAULT_SESSION] = record.get("feedback")
+        else:
+            latest = {request_session().key: data}
 
         # Check if the received data is a list
-        if not isinstance(data, list):
+        if not all(isinstance(feedback, list) for feedback in latest.values()):
             return jsonify({"status": "error", "message": "Invalid data format - expected a list"}), 400
 
-        feedback_data = data  # Store feedback globally
-
-        print("Feedback received:", feedback_data)  # Debugging output
+        for key, feedback in latest.items():
+            sessions.get(key).put_feedback(feedback)
+            if progress:
+                progress.publish(json.dumps({"t": "feedback", "s": key, "f": feedback}, separators=(",", ":")))
+            log.info("Feedback received for %s: %d notes", key, len(feedback))
+            log.debug("Feedback: %s", feedback)
 
         return jsonify({"status": "success", "message": "Feedback received"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 400
 
 
+# LIVE NOTE EVENTS (SERVER-SENT EVENTS). one event per recorded note ("note"),
+# per move to the next note ("next", "end") and the song's feedback
+# ("feedback"). the id of each event is its seq, a client that reconnects
+# with Last-Event-ID (or ?since=<seq>) gets the events it missed
+@app.route('/progress', methods=['GET'])
+def progress_events():
+    if progress is None:
+        return jsonify({"status": "error", "message": "No progress stream"}), 503
+    try:
+        seq = int(request.headers.get("Last-Event-ID") or request.args.get("since", progress.seq))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid event id"}), 400
+
+    def stream(seq):
+        yield "retry: 1000\n\n"
+        while True:
+            events = progress.wait(seq, timeout=SSE_KEEPALIVE)
+            if not events:
+                yield ": keepalive\n\n" # also notices a client that went away
+                continue
+            yield "".join(f"id: {event_seq}\ndata: {text}\n\n" for event_seq, text in events)
+            seq = events[-1][0]
+
+    return Response(stream(seq), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# STAGE TIMINGS OF THE PLAYER, json by default or prometheus text with ?format=prometheus
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    try:
+        with open(METRICS_FILE_PATH, 'r') as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError):
+        return jsonify({"status": "pending", "message": "No metrics yet"}), 503
+
+    snapshot["age"] = time.time() - snapshot.get("time", 0) # seconds since the player wrote it
+    snapshot.setdefault("counters", {}).update(sessions_evicted=sessions.evicted)
+    snapshot.setdefault("gauges", {}).update(sessions=len(sessions))
+    if request.args.get("format") == "prometheus" or "text/plain" in request.headers.get("Accept", ""):
+        return Response(prometheus_text(snapshot), mimetype="text/plain; version=0.0.4")
+    return jsonify(snapshot), 200
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", action="store_true",
+                        help="flask debugger and reloader, and DEBUG logging. Not for the board")
+    args = parser.parse_args()
+    setup_logging(LOG_FILE, debug=args.debug)
+    progress = ProgressStream()
     disable_hotspot()
     setup_hotspot()  # Start the hotspots
-    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
+    app.run(host='0.0.0.0', port=5000, debug=args.debug, threaded=True)
     